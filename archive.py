@@ -0,0 +1,368 @@
+"""
+Compact binary archive for MQTT messages.
+
+An archive file starts with `MAGIC`, followed by blocks. Each block has a
+`BLOCK_HEADER` (codec, length of the stored block, number of records) and
+holds a (possibly compressed) batch of records. Each record is a
+`RECORD_HEADER` (receive time as unix seconds, topic length, payload length)
+followed by the UTF-8 topic and the raw payload.
+
+Next to each archive file `<name>.mqa` the writer keeps a sparse index
+`<name>.mqi` with one JSON line per block (file offset, time range, record
+count and the ids of the topics in the block). Topic ids are defined by
+`{"id": ..., "topic": ...}` lines before their first use. `query` uses the
+index to seek directly to the blocks matching a topic pattern and time range.
+"""
+import os
+import json
+import glob
+import time
+import queue
+import struct
+import datetime
+import threading
+
+MAGIC = b"MQAR\x01"
+BLOCK_HEADER = struct.Struct("<BII")
+RECORD_HEADER = struct.Struct("<dHI")
+
+CODEC_NONE = 0
+CODEC_GZIP = 1
+CODEC_ZSTD = 2
+CODECS = {None: CODEC_NONE, "gzip": CODEC_GZIP, "zstd": CODEC_ZSTD}
+
+
+def compress(codec, data):
+    if codec == CODEC_NONE:
+        return data
+    elif codec == CODEC_GZIP:
+        import gzip
+        return gzip.compress(data, compresslevel=6)
+    elif codec == CODEC_ZSTD:
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError("unknown codec {}".format(codec))
+
+
+def decompress(codec, data):
+    if codec == CODEC_NONE:
+        return data
+    elif codec == CODEC_GZIP:
+        import gzip
+        return gzip.decompress(data)
+    elif codec == CODEC_ZSTD:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("unknown codec {}".format(codec))
+
+
+def encode_records(records):
+    parts = []
+    for t, topic, payload in records:
+        topic = topic.encode("utf-8")
+        parts.append(RECORD_HEADER.pack(t, len(topic), len(payload)))
+        parts.append(topic)
+        parts.append(payload)
+    return b"".join(parts)
+
+
+def decode_records(data):
+    pos = 0
+    while pos < len(data):
+        t, topic_len, payload_len = RECORD_HEADER.unpack_from(data, pos)
+        pos += RECORD_HEADER.size
+        topic = data[pos:pos + topic_len].decode("utf-8")
+        pos += topic_len
+        yield t, topic, data[pos:pos + payload_len]
+        pos += payload_len
+
+
+def iter_blocks(f):
+    """
+    Yield `(offset, codec, count, stored_data)` for every block of an open archive file.
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("not an MQTT archive")
+    while True:
+        offset = f.tell()
+        header = f.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            return
+        codec, length, count = BLOCK_HEADER.unpack(header)
+        data = f.read(length)
+        if len(data) < length:
+            # incomplete block at the end of a file which is still being written
+            return
+        yield offset, codec, count, data
+
+
+def index_path(path):
+    return os.path.splitext(path)[0] + ".mqi"
+
+
+def topic_matches(pattern, topic):
+    """
+    Check if `topic` matches an MQTT subscription `pattern` (with `+` and `#` wildcards).
+    """
+    pattern_parts = pattern.split("/")
+    topic_parts = topic.split("/")
+    for i, part in enumerate(pattern_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[i]:
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+
+class IndexWriter(object):
+    def __init__(self, path):
+        self._file = open(path, "a")
+        self._topic_ids = {}
+
+    def add_block(self, offset, records):
+        topic_ids = set()
+        for _, topic, _ in records:
+            topic_id = self._topic_ids.get(topic)
+            if topic_id is None:
+                topic_id = self._topic_ids[topic] = len(self._topic_ids)
+                self._file.write(json.dumps({"id": topic_id, "topic": topic}) + "\n")
+            topic_ids.add(topic_id)
+        times = [t for t, _, _ in records]
+        self._file.write(json.dumps({
+            "offset": offset,
+            "t0": min(times),
+            "t1": max(times),
+            "n": len(records),
+            "topics": sorted(topic_ids),
+        }) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def load_index(path):
+    """
+    Return the list of block entries of an archive file, with topic names instead of ids.
+
+    The index is rebuilt from the archive file if it is missing.
+    """
+    if not os.path.exists(index_path(path)):
+        build_index(path)
+    topics = {}
+    blocks = []
+    with open(index_path(path)) as indexfile:
+        for line in indexfile:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # incomplete line at the end of an index which is still being written
+                break
+            if "topic" in entry:
+                topics[entry["id"]] = entry["topic"]
+            else:
+                entry["topics"] = [topics[i] for i in entry["topics"]]
+                blocks.append(entry)
+    return blocks
+
+
+def build_index(path):
+    """
+    (Re)build the index of an archive file by scanning it once.
+    """
+    index = IndexWriter(index_path(path) + ".tmp")
+    with open(path, "rb") as f:
+        for offset, codec, _, data in iter_blocks(f):
+            index.add_block(offset, list(decode_records(decompress(codec, data))))
+    index.close()
+    os.replace(index_path(path) + ".tmp", index_path(path))
+
+
+def read_block(f, offset):
+    f.seek(offset)
+    codec, length, count = BLOCK_HEADER.unpack(f.read(BLOCK_HEADER.size))
+    return decode_records(decompress(codec, f.read(length)))
+
+
+def archive_files(paths):
+    """
+    Archive files in `paths` (files or directories with `*.mqa` files), sorted.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += glob.glob(os.path.join(path, "*.mqa"))
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def query(paths, topic="#", start=None, end=None):
+    """
+    Yield `(time, topic, payload)` of all records matching `topic` within [`start`, `end`].
+
+    `paths` may be archive files or directories, `start` and `end` are unix
+    times (or None for an open range). Only blocks whose index entry matches
+    are read.
+    """
+    for path in archive_files(paths):
+        blocks = [block for block in load_index(path)
+                  if (start is None or block["t1"] >= start)
+                  and (end is None or block["t0"] <= end)
+                  and any(topic_matches(topic, t) for t in block["topics"])]
+        if len(blocks) == 0:
+            continue
+        with open(path, "rb") as f:
+            for block in blocks:
+                for record in read_block(f, block["offset"]):
+                    t, record_topic, _ = record
+                    if (start is None or t >= start) and (end is None or t <= end) \
+                            and topic_matches(topic, record_topic):
+                        yield record
+
+
+def read_archive(path):
+    """
+    Yield `(time, topic, payload)` for every record in an archive file.
+    """
+    with open(path, "rb") as f:
+        for _, codec, _, data in iter_blocks(f):
+            yield from decode_records(decompress(codec, data))
+
+
+class ArchiveWriter(object):
+    """
+    Writes MQTT messages to rotating archive files on a background thread.
+
+    `put` never blocks: messages are handed over through a bounded queue and
+    counted as dropped if the queue is full. The writer thread collects up to
+    `batch_size` messages (or whatever arrived within `flush_interval`) into
+    one block. A new file is started when the current one exceeds
+    `max_bytes` or is older than `rotate_interval` seconds. Each file gets
+    a side index unless `index` is False.
+    """
+    def __init__(self, directory, prefix="mqtt", compression=None, max_bytes=256 * 1024 * 1024,
+                 rotate_interval=24 * 3600, queue_size=100000, batch_size=1000, flush_interval=1.0,
+                 index=True):
+        self.directory = directory
+        self.prefix = prefix
+        self.codec = CODECS[compression]
+        if self.codec == CODEC_ZSTD:
+            import zstandard # fail early if zstd is not available
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.index = index
+        self.received = 0
+        self.written = 0
+        self.dropped = 0
+        self.blocks = 0
+        self.files = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._counter_lock = threading.Lock() # `put` is called from the client and publisher threads
+        self._file = None
+        self._index = None
+        self._file_opened = 0
+        self._stop = object()
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="ArchiveWriter", daemon=True)
+        self._thread.start()
+
+    def put(self, topic, payload, t=None):
+        """
+        Queue a message for writing, may be called from several threads.
+        """
+        if t is None:
+            t = time.time()
+        try:
+            self._queue.put_nowait((t, topic, bytes(payload)))
+            dropped = 0
+        except queue.Full:
+            dropped = 1
+        with self._counter_lock:
+            self.received += 1
+            self.dropped += dropped
+
+    def stats(self):
+        with self._counter_lock:
+            received, dropped = self.received, self.dropped
+        return {
+            "received": received,
+            "written": self.written,
+            "dropped": dropped,
+            "queued": self._queue.qsize(),
+            "blocks": self.blocks,
+            "files": self.files,
+        }
+
+    def _open(self):
+        if self._file is not None:
+            self._close_file()
+        name = "{}-{}.mqa".format(self.prefix, datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f"))
+        self._file = open(os.path.join(self.directory, name), "ab")
+        self._file.write(MAGIC)
+        if self.index:
+            self._index = IndexWriter(index_path(self._file.name))
+        self._file_opened = time.monotonic()
+        self.files += 1
+
+    def _close_file(self):
+        self._file.close()
+        self._file = None
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def _write_block(self, records):
+        if self._file is None \
+                or self._file.tell() >= self.max_bytes \
+                or time.monotonic() - self._file_opened >= self.rotate_interval:
+            self._open()
+        data = compress(self.codec, encode_records(records))
+        offset = self._file.tell()
+        self._file.write(BLOCK_HEADER.pack(self.codec, len(data), len(records)))
+        self._file.write(data)
+        self._file.flush()
+        if self._index is not None:
+            self._index.add_block(offset, records)
+        self.blocks += 1
+        self.written += len(records)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            if first is self._stop:
+                break
+            records = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(records) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is self._stop:
+                    stopping = True
+                    break
+                records.append(item)
+            self._write_block(records)
+        if self._file is not None:
+            self._close_file()
+
+    def close(self):
+        self._queue.put(self._stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
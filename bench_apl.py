@@ -0,0 +1,45 @@
+"""
+Benchmark the row-wise and the columnar parser for WGMS glider exports.
+
+usage: python bench_apl.py [number of rows]
+"""
+import sys
+import datetime
+import numpy as np
+
+from benchtools import bench
+from get_apl import FIELDMAP, parse_export_rows, parse_export_columns, latest_row
+
+def synthetic_export(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    header = list(FIELDMAP.keys()) + ["Structure ID", "User Name"]
+    start = datetime.datetime(2020, 1, 20)
+    lines = [",".join(header)]
+    for i in rng.permutation(rows):
+        t = (start + datetime.timedelta(seconds=60 * int(i))).strftime("%m/%d/%Y %H:%M:%S")
+        values = []
+        for col in header:
+            if col in ("TimeStamp", "Created On"):
+                values.append(t)
+            elif col in ("Structure ID", "User Name"):
+                values.append("x")
+            elif rng.random() < 0.05:
+                values.append("")
+            else:
+                values.append("{:.5f}".format(rng.normal(10., 5.)))
+        lines.append(",".join(values))
+    return "\n".join(lines) + "\n"
+
+def _main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    text = synthetic_export(rows)
+    print("{} rows, {:.1f} MB".format(rows, len(text) / 1e6))
+
+    latest_rows = bench("rows", lambda: sorted(parse_export_rows(text), key=lambda x: x["time"])[-1])
+    latest_columns = bench("columns", lambda: latest_row(parse_export_columns(text)))
+
+    assert np.datetime64(latest_rows["time"], "s") == latest_columns["time"]
+    assert np.isclose(latest_rows["lat"], latest_columns["lat"], equal_nan=True)
+
+if __name__ == "__main__":
+    _main()
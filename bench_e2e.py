@@ -0,0 +1,292 @@
+"""
+End-to-end benchmark of the importers against local fake sources and a local broker.
+
+For every importer and platform count, the fetch, parse, serialize and
+publish stages are timed per platform. Then the source data is changed and
+one polling cycle is run through the importer's `get_sources` and the
+`poller` engine. A subscriber on the broker measures the latency from
+"source data changed" to "message on broker", and one more cycle without
+changes is timed (`idle_cycle_s`). Results are written as JSON,
+so runs can be compared with `--compare`.
+
+usage: python bench_e2e.py [--platforms 10 100 1000] [--output results.json] [--compare old.json]
+"""
+import sys
+import json
+import time
+import asyncio
+import datetime
+import platform
+import threading
+
+import numpy as np
+
+import fakebroker
+import fakeservers
+from benchtools import Subscriber
+import poller
+import get_swift
+import get_apl
+import get_noaa_ship
+import fr24
+from fr24 import FR24_scraper
+from fastnmea import FastNMEADecoder
+from httptail import HttpTail
+from mqtt_utils import EUREC4AMqttPublisher, json_default
+
+STAGES = ["fetch", "parse", "serialize", "publish"]
+GLIDER_AUTH = {"login": "bench", "password": "bench", "org": "bench"}
+# the synthetic aircraft spread beyond the EUREC4A area
+FAKE_BOUNDS = (90., -90., -180., 180.)
+
+
+def summary(values):
+    if len(values) == 0:
+        return {}
+    values = np.asarray(values) * 1000.
+    return {
+        "n": len(values),
+        "mean_ms": float(np.mean(values)),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p90_ms": float(np.percentile(values, 90)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(np.max(values)),
+    }
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.times = {stage: [] for stage in STAGES}
+        self._last = None
+
+    def start(self):
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.times[stage].append(now - self._last)
+        self._last = now
+
+    def summary(self):
+        return {stage: summary(times) for stage, times in self.times.items()}
+
+
+class ArrivalProbe(Subscriber):
+    """
+    Records when messages for a set of topics arrive at the broker.
+    """
+    def __init__(self, port):
+        self.arrivals = {}
+        self.expected = set()
+        self.done = threading.Event()
+        super().__init__(port, "platform/#")
+
+    def expect(self, topics):
+        with self.lock:
+            self.arrivals = {}
+            self.expected = set(topics)
+            self.done.clear()
+
+    def received(self, msg, now):
+        if msg.topic in self.expected and msg.topic not in self.arrivals:
+            self.arrivals[msg.topic] = now
+            if len(self.arrivals) == len(self.expected):
+                self.done.set()
+
+
+def stages_swift(sources, base_url, publisher, session):
+    timer = StageTimer()
+    for name in sources.buoys:
+        timer.start()
+        res = session.get(base_url + "/kml", params={"action": "kml", "buoy_name": name, "start": "",
+                                                     "end": "", "format": "json"})
+        body = res.content
+        timer.lap("fetch")
+        latest = get_swift.latest_record(get_swift.parse_swift_columns(json.loads(body), name))
+        timer.lap("parse")
+        json.dumps({"time": latest["time"], "lat": latest["lat"], "lon": latest["lon"]}, default=json_default)
+        timer.lap("serialize")
+        get_swift.publish_latest(publisher, name, latest)
+        timer.lap("publish")
+    return timer
+
+
+def stages_glider(sources, base_url, publisher, session):
+    timer = StageTimer()
+    api = get_apl.GliderApi(GLIDER_AUTH, base_url=base_url, session=session)
+    for vehicle in sources.gliders:
+        timer.start()
+        text = api.fetch_export(vehicle["wgms_record_id"], 42)
+        timer.lap("fetch")
+        latest = get_apl.latest_row(get_apl.parse_export_columns(text))
+        timer.lap("parse")
+        location = {"time": latest["time"], "lat": latest["lat"], "lon": latest["lon"]}
+        json.dumps(location, default=json_default)
+        timer.lap("serialize")
+        publisher.publish("platform/{}/location".format(vehicle["platform_id"]), location, retain=True)
+        timer.lap("publish")
+    return timer
+
+
+def stages_fr24(sources, base_url, publisher, session):
+    timer = StageTimer()
+    scraper = FR24_scraper(session=session, url=base_url + "/zones/fcgi/feed.js", bounds=FAKE_BOUNDS)
+    for registration in sources.aircraft:
+        timer.start()
+        text = scraper.fetch()
+        timer.lap("fetch")
+        scraper.parse(text)
+        location = scraper.lookup(registration)
+        timer.lap("parse")
+        json.dumps(location, default=json_default)
+        timer.lap("serialize")
+        publisher.publish("platform/{}/location".format(registration), location, retain=True)
+        timer.lap("publish")
+    return timer
+
+
+def stages_ship(sources, base_url, publisher, session):
+    timer = StageTimer()
+    for ship in sources.ships:
+        tail = HttpTail(base_url + "/ship/{}.txt".format(ship), linebreak=b"\n", session=session)
+        state = get_noaa_ship.NMEAAssetState()
+        timer.start()
+        lines = tail.poll()
+        timer.lap("fetch")
+        FastNMEADecoder().decode_lines(state, lines)
+        timer.lap("parse")
+        location = state.to_dict()
+        json.dumps(location, default=json_default)
+        timer.lap("serialize")
+        publisher.publish("platform/{}/location".format(ship), location, retain=True)
+        timer.lap("publish")
+    return timer
+
+
+def poll_sources_swift(sources, base_url, publisher):
+    return get_swift.get_sources(publisher, cursor=get_swift.SwiftCursor(statefile=None),
+                                 buoys=sources.buoys, url=base_url + "/kml")
+
+
+def poll_sources_glider(sources, base_url, publisher):
+    return get_apl.get_sources(publisher, config=GLIDER_AUTH, vehicles=sources.gliders, base_url=base_url)
+
+
+def poll_sources_fr24(sources, base_url, publisher):
+    # the cycles run back to back, interval=0 makes every one of them fetch the feed
+    return fr24.get_sources(publisher, aircraft=list(sources.aircraft), interval=0,
+                            url=base_url + "/zones/fcgi/feed.js", bounds=FAKE_BOUNDS)
+
+
+def poll_sources_ship(sources, base_url, publisher):
+    return get_noaa_ship.get_sources(publisher, assets=sources.ships, url=base_url + "/ship/{}.txt",
+                                     statefile=None, platform_ids={ship: ship for ship in sources.ships})
+
+
+IMPORTERS = {
+    "swift": (stages_swift, poll_sources_swift, lambda s: s.buoys),
+    "glider": (stages_glider, poll_sources_glider, lambda s: [g["platform_id"] for g in s.gliders]),
+    "fr24": (stages_fr24, poll_sources_fr24, lambda s: s.aircraft),
+    "ship": (stages_ship, poll_sources_ship, lambda s: s.ships),
+}
+
+
+async def run_cycle(poll_sources, http):
+    await asyncio.gather(*[source.poll(http) for source in poll_sources])
+
+
+def bench_importer(name, sources, base_url, broker_port, probe, timeout=120):
+    stages, make_poll_sources, platform_ids = IMPORTERS[name]
+    with EUREC4AMqttPublisher(host="127.0.0.1", port=broker_port, tls=False, verbose=False) as publisher:
+        with poller.AsyncHttpClient(max_workers=16, pool_maxsize=16) as http:
+            timer = stages(sources, base_url, publisher, http.session)
+
+            poll_sources = make_poll_sources(sources, base_url, publisher)
+            # the first cycle catches up with the history (cursors, tails, logins)
+            asyncio.run(run_cycle(poll_sources, http))
+
+            probe.expect(["platform/{}/location".format(p) for p in platform_ids(sources)])
+            changed = time.perf_counter()
+            sources.advance()
+            asyncio.run(run_cycle(poll_sources, http))
+            cycle = time.perf_counter() - changed
+            probe.done.wait(timeout)
+            with probe.lock:
+                latencies = [t - changed for t in probe.arrivals.values()]
+
+            # nothing changed since the last cycle: conditional requests and cached parse results
+            start = time.perf_counter()
+            asyncio.run(run_cycle(poll_sources, http))
+            idle_cycle = time.perf_counter() - start
+
+    return {
+        "importer": name,
+        "platforms": sources.platforms,
+        "stages": timer.summary(),
+        "cycle_s": cycle,
+        "idle_cycle_s": idle_cycle,
+        "delivered": len(latencies),
+        "latency": summary(latencies),
+    }
+
+
+def compare(results, old_results):
+    old = {(r["importer"], r["platforms"]): r for r in old_results["results"]}
+    print("{:8s} {:>9s} {:>10s} {:>10s} {:>10s} {:>10s} {:>10s}".format(
+        "importer", "platforms", *STAGES, "latency"))
+    for r in results["results"]:
+        o = old.get((r["importer"], r["platforms"]))
+        if o is None:
+            continue
+        ratios = []
+        for stage in STAGES:
+            ratios.append(r["stages"][stage]["p50_ms"] / o["stages"][stage]["p50_ms"])
+        ratios.append(r["latency"]["p50_ms"] / o["latency"]["p50_ms"])
+        print("{:8s} {:9d} ".format(r["importer"], r["platforms"])
+              + " ".join("{:9.2f}x".format(x) for x in ratios))
+
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description="end-to-end importer benchmark")
+    parser.add_argument("--platforms", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--importers", nargs="+", default=list(IMPORTERS), choices=list(IMPORTERS))
+    parser.add_argument("--history", type=int, default=100, help="records per platform")
+    parser.add_argument("--output", default=None, help="write JSON results to this file (default: stdout)")
+    parser.add_argument("--compare", default=None, help="print p50 ratios against an earlier result file")
+    args = parser.parse_args()
+
+    broker, broker_port = fakebroker.start_in_thread()
+    probe = ArrivalProbe(broker_port)
+    results = {
+        "meta": {
+            "time": datetime.datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "history": args.history,
+        },
+        "results": [],
+    }
+    for platforms in args.platforms:
+        sources = fakeservers.FakeSources(platforms=platforms, history=args.history)
+        server, base_url = fakeservers.start_in_thread(sources)
+        for name in args.importers:
+            result = bench_importer(name, sources, base_url, broker_port, probe)
+            print("{:8s} {:5d} platforms: cycle {:.3f} s, latency p50 {:.1f} ms".format(
+                name, platforms, result["cycle_s"], result["latency"].get("p50_ms", float("nan"))),
+                file=sys.stderr)
+            results["results"].append(result)
+        server.shutdown()
+    probe.close()
+
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as oldfile:
+            compare(results, json.load(oldfile))
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,78 @@
+"""
+Benchmark the payload encoders on typical location messages.
+
+`two-pass` is the old publisher path: the deduplicator serialized the
+message with sorted keys for its digest and the publisher serialized it
+again. The other rows encode once and hash the encoded bytes.
+
+usage: python bench_encoders.py [number of messages]
+"""
+import sys
+import time
+import datetime
+
+import numpy as np
+
+from encoders import ENCODERS, get_encoder
+from mqtt_utils import message_digest, json_default
+
+
+def location_messages(n):
+    t = datetime.datetime(2020, 1, 20)
+    messages = []
+    for i in range(n):
+        t += datetime.timedelta(seconds=30)
+        if i % 3 == 0:
+            # buoys and gliders
+            messages.append({"time": t, "lat": 13.1 + 1e-5 * i, "lon": -57.3 + 3e-5 * i})
+        elif i % 3 == 1:
+            # aircraft
+            messages.append({"time": t.replace(tzinfo=datetime.timezone.utc), "lat": 13.1 + 1e-4 * i,
+                             "lon": -57.3 - 1e-4 * i, "heading": 93., "ground_speed": 72.5,
+                             "press_alt": 4500. + i % 100})
+        else:
+            # ships
+            messages.append({"time": np.datetime64(t), "lat": 13.1, "lon": -57.3 + 1e-6 * i,
+                             "heading": 271.3, "speed": 5.1})
+    return messages
+
+
+def two_pass(messages):
+    import json
+    for message in messages:
+        message_digest(message)
+        json.dumps(message, default=json_default).encode("utf-8")
+
+
+def encode_once(encoder, messages):
+    for message in messages:
+        message_digest(encoder.encode(message))
+
+
+def bench(name, func, n, size=None, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    print("{:10s} {:8.2f} us/message {:>12s}".format(
+        name, best / n * 1e6, "" if size is None else "{:.1f} bytes".format(size)))
+    return best
+
+
+def _main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    messages = location_messages(n)
+    baseline = bench("two-pass", lambda: two_pass(messages), n)
+    for name in ENCODERS:
+        try:
+            encoder = get_encoder(name)
+        except ImportError as e:
+            print("{:10s} not available ({})".format(name, e))
+            continue
+        size = np.mean([len(encoder.encode(m)) for m in messages[:1000]])
+        best = bench(name, lambda: encode_once(encoder, messages), n, size)
+        print("{:10s} {:8.2f}x".format("", baseline / best))
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,65 @@
+"""
+Benchmark the pynmea2 stream reader against the fast NMEA decoder for ship tracks.
+
+usage: python bench_nmea.py [size of the synthetic log in MB]
+"""
+import sys
+import datetime
+
+import pynmea2
+
+from benchtools import bench, nmea_sentence, nmea_latlon
+from fastnmea import FastNMEADecoder
+from get_noaa_ship import NMEAAssetState
+
+def synthetic_log(megabytes):
+    t = datetime.datetime(2020, 1, 20)
+    lat, lon = 13.1, -57.3
+    lines = []
+    size = 0
+    while size < megabytes * 1e6:
+        hms = t.strftime("%H%M%S.00")
+        la, la_h = nmea_latlon(lat, 2)
+        lo, lo_h = nmea_latlon(lon, 3)
+        la_h = "NS"[la_h]
+        lo_h = "EW"[lo_h]
+        for body in [
+                "GPGGA,{},{},{},{},{},1,08,0.9,12.0,M,-40.0,M,,".format(hms, la, la_h, lo, lo_h),
+                "GPRMC,{},A,{},{},{},{},10.1,93.2,{},,,A".format(hms, la, la_h, lo, lo_h, t.strftime("%d%m%y")),
+                "GPVTG,93.2,T,,M,10.1,N,18.7,K,A",
+                "GPZDA,{},{},00,00".format(hms, t.strftime("%d,%m,%Y")),
+                "HEHDT,93.5,T",
+                ]:
+            line = nmea_sentence(body)
+            lines.append(line)
+            size += len(line)
+        t += datetime.timedelta(seconds=1)
+        lat += 1e-5
+        lon += 3e-5
+    return "".join(lines)
+
+def run_pynmea2(log):
+    state = NMEAAssetState()
+    for msg in pynmea2.NMEAStreamReader().next(log):
+        state.update(msg)
+    return state
+
+def run_fast(log):
+    state = NMEAAssetState()
+    FastNMEADecoder().decode_lines(state, log.split("\n"))
+    return state
+
+def _main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    log = synthetic_log(megabytes)
+    print("{:.1f} MB, {} sentences".format(len(log) / 1e6, log.count("\n")))
+
+    slow = bench("pynmea2", lambda: run_pynmea2(log))
+    fast = bench("fast", lambda: run_fast(log))
+
+    assert slow.timestamp == fast.timestamp
+    assert abs(slow.lat - fast.lat) < 1e-9 and abs(slow.lon - fast.lon) < 1e-9
+    assert abs(slow.ground_speed - fast.ground_speed) < 1e-9 and slow.heading == fast.heading
+
+if __name__ == "__main__":
+    _main()
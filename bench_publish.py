@@ -0,0 +1,62 @@
+"""
+Publish throughput of `EUREC4AMqttPublisher` against a local broker.
+
+For each QoS and in-flight window, `n` distinct location messages are
+published with `publish_many` (messages beyond the window wait in memory) and
+the publisher waits until all of them are acknowledged. A subscriber counts the messages arriving on the broker.
+
+usage: python bench_publish.py [number of messages]
+"""
+import sys
+import time
+import datetime
+import threading
+
+import fakebroker
+from benchtools import Counter
+from mqtt_utils import EUREC4AMqttPublisher, ACKED
+
+
+def messages(n, run):
+    t = datetime.datetime(2020, 1, 20)
+    return [("bench/{}/{}/location".format(run, i % 100),
+             {"time": t + datetime.timedelta(seconds=i), "lat": 13.1 + 1e-5 * i, "lon": -57.3})
+            for i in range(n)]
+
+
+def bench(port, counter, n, qos, max_inflight, run):
+    batch = messages(n, run)
+    acked = [0]
+    lock = threading.Lock()
+
+    def on_result(topic, result):
+        if result == ACKED:
+            with lock:
+                acked[0] += 1
+
+    counter.reset()
+    with EUREC4AMqttPublisher(host="127.0.0.1", port=port, tls=False, verbose=False, deduplicate=False,
+                              qos=qos, max_inflight=max_inflight, max_queued=n, scheduler=None,
+                              deadband=None) as publisher:
+        start = time.perf_counter()
+        publisher.publish_many(batch, callback=on_result)
+        publisher.flush(60)
+        elapsed = time.perf_counter() - start
+    delivered = counter.wait(n)
+    print("qos {} window {:>5}: {:8.0f} messages/s, {} acked, {} delivered".format(
+        qos, str(max_inflight), n / elapsed, acked[0], delivered))
+
+
+def _main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    broker, port = fakebroker.start_in_thread()
+    counter = Counter(port, "bench/#")
+    run = 0
+    for qos in (0, 1, 2):
+        for max_inflight in (10, 100, 1000, None):
+            bench(port, counter, n, qos, max_inflight, run)
+            run += 1
+    counter.close()
+
+if __name__ == "__main__":
+    _main()
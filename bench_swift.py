@@ -0,0 +1,43 @@
+"""
+Benchmark the per-record and the columnar parser for SWIFT server responses.
+
+The default size corresponds to 10 days of history for one buoy at one
+record per 30 s.
+
+usage: python bench_swift.py [number of records]
+"""
+import sys
+import datetime
+import numpy as np
+
+from benchtools import bench
+from get_swift import parse_swift_response, parse_swift_columns, latest_record
+
+def synthetic_response(records, name="SWIFT 16", seed=0):
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2020, 1, 20)
+    data = []
+    # the server does not guarantee any order
+    for i in rng.permutation(records):
+        data.append({
+            "timestamp": (start + datetime.timedelta(seconds=30 * int(i))).isoformat() + "Z",
+            "lat": 13.1 + 1e-5 * int(i),
+            "lon": -57.3 + 3e-5 * int(i),
+            "wind_speed": float(rng.normal(7., 2.)),
+            "wave_height": float(rng.normal(1.5, 0.3)),
+            "voltage": None if rng.random() < 0.3 else float(rng.normal(12., 0.1)),
+        })
+    return {"success": True, "buoys": [{"name": name, "data": data}]}
+
+def _main():
+    records = int(sys.argv[1]) if len(sys.argv) > 1 else 28800
+    res = synthetic_response(records)
+    print("{} records".format(records))
+
+    latest_rows = bench("records", lambda: parse_swift_response(res, "SWIFT 16")[-1])
+    latest_columns = bench("columns", lambda: latest_record(parse_swift_columns(res, "SWIFT 16")))
+
+    assert latest_rows == latest_columns, (latest_rows, latest_columns)
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,100 @@
+"""
+Shared helpers of the benchmarks, load tests and tests.
+
+- `bench`: best wall time of a few runs of a function
+- `nmea_sentence` / `nmea_latlon`: build NMEA 0183 sentences
+- `Subscriber`: a second MQTT client which watches what arrives at the broker
+"""
+import time
+import threading
+from functools import reduce
+from operator import xor
+
+from mqtt_utils import get_mqtt_client
+
+
+def bench(name, func, repeat=3):
+    """
+    Print the best time of `repeat` calls of `func`, returns the result of the last one.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    print("{:10s} {:8.3f} s".format(name, best))
+    return result
+
+
+def nmea_sentence(body):
+    """
+    A complete NMEA sentence with checksum and line ending.
+    """
+    return "${}*{:02X}\r\n".format(body, reduce(xor, body.encode("ascii"), 0))
+
+
+def nmea_latlon(value, width):
+    """
+    `(ddmm.mmmm, hemisphere)` of a coordinate, `hemisphere` is 0 for N / E and 1 for S / W.
+    """
+    hemisphere = 0 if value >= 0 else 1
+    value = abs(value)
+    degrees = int(value)
+    return "{:0{}d}{:07.4f}".format(degrees, width, (value - degrees) * 60), hemisphere
+
+
+class Subscriber(object):
+    """
+    Subscribes to `topic` and calls `received(msg, now)` for every message under `self.lock`.
+
+    `now` is the `time.perf_counter()` of the arrival. Subclasses set up
+    their state before calling `__init__`, retained messages may arrive
+    right away.
+    """
+    def __init__(self, port, topic="#", host="127.0.0.1", tls=False):
+        self.lock = threading.Lock()
+        self.client = get_mqtt_client(tls=tls)
+        subscribed = threading.Event()
+        self.client.on_connect = lambda client, *args: client.subscribe(topic)
+        self.client.on_subscribe = lambda *args: subscribed.set()
+        self.client.on_message = self._on_message
+        self.client.connect(host, port, 60)
+        self.client.loop_start()
+        subscribed.wait(10)
+
+    def _on_message(self, client, userdata, msg):
+        now = time.perf_counter()
+        with self.lock:
+            self.received(msg, now)
+
+    def received(self, msg, now):
+        pass
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class Counter(Subscriber):
+    """
+    Counts the arriving messages.
+    """
+    def __init__(self, port, topic="#", **kwargs):
+        self.count = 0
+        super().__init__(port, topic, **kwargs)
+
+    def received(self, msg, now):
+        self.count += 1
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+
+    def wait(self, n, timeout=30):
+        """
+        Wait until `n` messages arrived, returns the count.
+        """
+        deadline = time.monotonic() + timeout
+        while self.count < n and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.count
@@ -0,0 +1,124 @@
+"""
+Dead-band change detection for platform messages.
+
+A message is only published if one of its fields moved by more than the
+field's tolerance since the last *published* message of the topic (so slow
+drifts add up until they become significant), if its fields changed, or if
+nothing was published for `max_silence` seconds.
+
+Tolerances are keyed by field name. `position` is the distance in metres
+between `lat`/`lon` pairs, `ANGULAR_FIELDS` are compared on the circle,
+other numbers by their absolute difference. Fields without a tolerance must
+be equal, `time` is ignored. The publisher uses a filter if `mqtt_import.json`
+has a `deadband` section, e.g.:
+
+    "deadband": {"tolerances": {"position": 50, "voltage": 0.1}, "max_silence": 600}
+"""
+import math
+import time
+import numbers
+import threading
+from collections import OrderedDict
+
+EARTH_RADIUS = 6371000.
+
+DEFAULT_TOLERANCES = {
+    "position": 25., # m
+    "heading": 5., # degrees
+    "ground_speed": 0.5, # m/s
+    "press_alt": 30., # m
+    "gps_msl_alt": 30., # m
+    "voltage": 0.05, # V
+    "mag": 0.5, # wind speed, m/s
+    "height": 0.1, # wave height, m
+}
+
+ANGULAR_FIELDS = {"heading"}
+IGNORED_FIELDS = {"time"}
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance in metres.
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 \
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1., math.sqrt(a)))
+
+
+def angle_difference(a, b):
+    d = abs(a - b) % 360.
+    return min(d, 360. - d)
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+class DeadbandFilter(object):
+    def __init__(self, tolerances=None, max_silence=300, max_topics=10000):
+        self.tolerances = dict(DEFAULT_TOLERANCES)
+        if tolerances is not None:
+            self.tolerances.update(tolerances)
+        self.max_silence = max_silence
+        self.max_topics = max_topics
+        self.last = OrderedDict() # topic -> (monotonic time, last published message)
+        self._lock = threading.Lock() # `forget` is also called from the client's network thread
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**config)
+
+    def changed(self, old, new):
+        """
+        True if `new` differs from `old` by more than the tolerances.
+        """
+        if old.keys() != new.keys():
+            return True
+        position_tolerance = self.tolerances.get("position")
+        check_position = position_tolerance is not None and "lat" in new and "lon" in new \
+            and all(_is_number(d[k]) for d in (old, new) for k in ("lat", "lon"))
+        if check_position and distance(old["lat"], old["lon"], new["lat"], new["lon"]) > position_tolerance:
+            return True
+        for key, value in new.items():
+            if key in IGNORED_FIELDS or (check_position and key in ("lat", "lon")):
+                continue
+            previous = old[key]
+            tolerance = self.tolerances.get(key)
+            if tolerance is None or not (_is_number(value) and _is_number(previous)):
+                if value != previous:
+                    return True
+                continue
+            if key in ANGULAR_FIELDS:
+                difference = angle_difference(value, previous)
+            else:
+                difference = abs(value - previous)
+            if difference > tolerance:
+                return True
+        return False
+
+    def is_significant(self, topic, data):
+        """
+        Decide whether `data` should be published on `topic` and remember it if so.
+        """
+        if not isinstance(data, dict):
+            return True
+        now = time.monotonic()
+        with self._lock:
+            entry = self.last.get(topic)
+            if entry is not None and now - entry[0] < self.max_silence and not self.changed(entry[1], data):
+                return False
+            self.last[topic] = (now, dict(data))
+            self.last.move_to_end(topic)
+            while len(self.last) > self.max_topics:
+                self.last.popitem(last=False)
+        return True
+
+    def forget(self, topic):
+        with self._lock:
+            self.last.pop(topic, None)
+
+    def __len__(self):
+        return len(self.last)
@@ -0,0 +1,102 @@
+"""
+Payload encoders for the publisher.
+
+Every encoder turns a message (a dict with numbers, strings, datetimes and
+NumPy scalars) into bytes exactly once; the publisher then uses these bytes
+for deduplication, archiving and publishing. Available encoders:
+
+- `json`: the standard library, the default
+- `orjson`: the same JSON, several times faster (needs `orjson`)
+- `msgpack`: MessagePack (needs `msgpack`)
+- `cbor`: CBOR (needs `cbor2`)
+
+Datetimes are always encoded as ISO 8601 strings. `content_type` is sent
+with each message on MQTT 5 connections, otherwise the publisher announces
+the encoding of non-JSON topics on `encoding/<topic>`.
+"""
+import json
+import datetime
+
+import numpy as np
+
+from mqtt_utils import json_default
+
+
+def _plain(obj):
+    """
+    Convert values the binary encoders do not know about.
+    """
+    if isinstance(obj, (np.datetime64, datetime.datetime, datetime.date)):
+        return str(obj) if isinstance(obj, np.datetime64) else obj.isoformat()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("can not encode {!r}".format(obj))
+
+
+class JsonEncoder(object):
+    name = "json"
+    content_type = "application/json"
+
+    def encode(self, data):
+        return json.dumps(data, default=json_default).encode("utf-8")
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class OrjsonEncoder(JsonEncoder):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        self._options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def encode(self, data):
+        return self._orjson.dumps(data, default=_plain, option=self._options)
+
+    def decode(self, payload):
+        return self._orjson.loads(payload)
+
+
+class MsgpackEncoder(object):
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def encode(self, data):
+        return self._msgpack.packb(data, default=_plain, datetime=False)
+
+    def decode(self, payload):
+        return self._msgpack.unpackb(payload)
+
+
+class CborEncoder(object):
+    name = "cbor"
+    content_type = "application/cbor"
+
+    def __init__(self):
+        import cbor2
+        self._cbor2 = cbor2
+
+    def encode(self, data):
+        return self._cbor2.dumps(data, default=lambda encoder, obj: encoder.encode(_plain(obj)))
+
+    def decode(self, payload):
+        return self._cbor2.loads(payload)
+
+
+ENCODERS = {encoder.name: encoder for encoder in [JsonEncoder, OrjsonEncoder, MsgpackEncoder, CborEncoder]}
+
+
+def get_encoder(name="json"):
+    """
+    Create the encoder called `name`, raises ImportError if its package is missing.
+    """
+    try:
+        return ENCODERS[name]()
+    except KeyError:
+        raise ValueError("unknown encoding {}, choose from {}".format(name, ", ".join(ENCODERS)))
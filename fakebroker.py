@@ -0,0 +1,209 @@
+"""
+Minimal MQTT 3.1.1 broker for local tests and benchmarks.
+
+Supports CONNECT, PUBLISH (QoS 0, 1 and 2 from clients), retained messages,
+SUBSCRIBE / UNSUBSCRIBE with wildcards, PINGREQ and DISCONNECT. Messages are
+delivered to subscribers with QoS 0. There is no authentication, no TLS and
+no persistence. With `hold_acks` set, PUBACK / PUBREC packets are held back
+until `release_acks()` is called, e.g. to fill a client's in-flight window.
+
+usage: python fakebroker.py [--host 127.0.0.1] [--port 1883]
+"""
+import asyncio
+import struct
+import threading
+
+from archive import topic_matches
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def encode_length(length):
+    out = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        out.append(byte)
+        if length == 0:
+            return bytes(out)
+
+
+def packet(packet_type, flags, body):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+def publish_packet(topic, payload, retain=False):
+    topic = topic.encode("utf-8")
+    return packet(PUBLISH, 1 if retain else 0, struct.pack("!H", len(topic)) + topic + payload)
+
+
+async def read_packet(reader):
+    first = await reader.readexactly(1)
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7f) * multiplier
+        if byte & 0x80 == 0:
+            break
+        multiplier *= 128
+    body = await reader.readexactly(length)
+    return first[0] >> 4, first[0] & 0x0f, body
+
+
+def read_string(body, pos):
+    length, = struct.unpack_from("!H", body, pos)
+    pos += 2
+    return body[pos:pos + length].decode("utf-8"), pos + length
+
+
+class FakeBroker(object):
+    def __init__(self):
+        self.subscriptions = {} # writer -> set of topic filters
+        self.retained = {}
+        self.messages_in = 0
+        self.messages_out = 0
+        self.server = None
+        self.loop = None
+        self.hold_acks = False
+        self.held_acks = []
+
+    async def start(self, host="127.0.0.1", port=1883):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    def _release_acks(self):
+        held, self.held_acks = self.held_acks, []
+        for writer, data in held:
+            if not writer.is_closing():
+                writer.write(data)
+
+    def release_acks(self):
+        """
+        Stop holding back acknowledgements and send the held ones, may be called from any thread.
+        """
+        self.hold_acks = False
+        self.loop.call_soon_threadsafe(self._release_acks)
+
+    def _deliver(self, topic, payload):
+        data = publish_packet(topic, payload)
+        for writer, filters in list(self.subscriptions.items()):
+            if any(topic_matches(f, topic) for f in filters):
+                writer.write(data)
+                self.messages_out += 1
+
+    async def _handle(self, reader, writer):
+        try:
+            packet_type, _, body = await read_packet(reader)
+            if packet_type != CONNECT:
+                return
+            writer.write(packet(CONNACK, 0, b"\x00\x00"))
+            self.subscriptions[writer] = set()
+            while True:
+                packet_type, flags, body = await read_packet(reader)
+                if packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic, pos = read_string(body, 0)
+                    if qos > 0:
+                        packet_id = body[pos:pos + 2]
+                        pos += 2
+                        ack = packet(PUBACK if qos == 1 else PUBREC, 0, packet_id)
+                        if self.hold_acks:
+                            self.held_acks.append((writer, ack))
+                        else:
+                            writer.write(ack)
+                    payload = body[pos:]
+                    self.messages_in += 1
+                    if flags & 0x01:
+                        if len(payload) == 0:
+                            self.retained.pop(topic, None)
+                        else:
+                            self.retained[topic] = payload
+                    self._deliver(topic, payload)
+                elif packet_type == PUBREL:
+                    writer.write(packet(PUBCOMP, 0, body[:2]))
+                elif packet_type == SUBSCRIBE:
+                    packet_id = body[:2]
+                    pos = 2
+                    granted = bytearray()
+                    new_filters = []
+                    while pos < len(body):
+                        topic_filter, pos = read_string(body, pos)
+                        pos += 1 # requested QoS, everything is delivered with QoS 0
+                        new_filters.append(topic_filter)
+                        granted.append(0)
+                    self.subscriptions[writer].update(new_filters)
+                    writer.write(packet(SUBACK, 0, packet_id + bytes(granted)))
+                    for topic, payload in list(self.retained.items()):
+                        if any(topic_matches(f, topic) for f in new_filters):
+                            writer.write(publish_packet(topic, payload, retain=True))
+                elif packet_type == UNSUBSCRIBE:
+                    pos = 2
+                    while pos < len(body):
+                        topic_filter, pos = read_string(body, pos)
+                        self.subscriptions[writer].discard(topic_filter)
+                    writer.write(packet(UNSUBACK, 0, body[:2]))
+                elif packet_type == PINGREQ:
+                    writer.write(packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    return
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.subscriptions.pop(writer, None)
+            writer.close()
+
+
+def start_in_thread(host="127.0.0.1", port=0):
+    """
+    Run a `FakeBroker` on a background thread, returns `(broker, port)`.
+    """
+    broker = FakeBroker()
+    started = threading.Event()
+    result = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        result["port"] = loop.run_until_complete(broker.start(host, port))
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name="FakeBroker", daemon=True).start()
+    started.wait()
+    return broker, result["port"]
+
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description="minimal local MQTT broker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    async def serve():
+        broker = FakeBroker()
+        port = await broker.start(args.host, args.port)
+        print("listening on {}:{}".format(args.host, port))
+        await broker.server.serve_forever()
+
+    asyncio.run(serve())
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,218 @@
+"""
+Local stand-ins for the HTTP data sources, for benchmarks and offline tests.
+
+A single threaded HTTP server serves synthetic data for any number of
+platforms:
+
+- `/kml`: SWIFT server JSON (see `get_swift.get_swift_buoy`)
+- `/webservices/entityapi.asmx` and `/pages/exportPage.aspx`: WGMS login and
+  CSV exports (see `get_apl.GliderApi`)
+- `/zones/fcgi/feed.js`: FlightRadar24 feed, filtered by `bounds` (see `fr24.FR24_scraper`)
+- `/ship/<asset>.txt`: appended NMEA logs with Range support (see `httptail`)
+
+Complete responses carry an `ETag` and are answered with `304 Not Modified`
+if it matches `If-None-Match`.
+
+`FakeSources.advance()` adds a new record to every platform.
+"""
+import re
+import json
+import hashlib
+import datetime
+import threading
+import http.server
+from urllib.parse import urlparse, parse_qs
+
+from get_apl import FIELDMAP
+from benchtools import nmea_sentence, nmea_latlon
+
+
+class FakeSources(object):
+    """
+    Synthetic platforms, each with `history` records spaced `step` apart.
+    """
+    def __init__(self, platforms=10, history=100, step=datetime.timedelta(seconds=30), start=None):
+        self.platforms = platforms
+        self.step = step
+        self.lock = threading.Lock()
+        self.buoys = ["SWIFT {}".format(i) for i in range(platforms)]
+        self.gliders = [{"platform_id": "SV3-{}".format(i), "wgms_record_id": i} for i in range(platforms)]
+        self.aircraft = ["FAKE-{}".format(i) for i in range(platforms)]
+        self.ships = ["SHIP{}".format(i) for i in range(platforms)]
+        self.records = []
+        self.ship_logs = {ship: bytearray() for ship in self.ships}
+        self._cache = {}
+        if start is None:
+            start = datetime.datetime.utcnow().replace(microsecond=0) - history * step
+        self.time = start
+        for _ in range(history):
+            self.advance()
+
+    def position(self, i, n):
+        return 13. + 0.01 * i + 1e-4 * n, -57. - 0.01 * i + 2e-4 * n
+
+    def advance(self):
+        """
+        Add one record to every platform.
+        """
+        with self.lock:
+            self.time += self.step
+            n = len(self.records)
+            self.records.append(self.time)
+            for i, ship in enumerate(self.ships):
+                lat, lon = self.position(i, n)
+                hms = self.time.strftime("%H%M%S.00")
+                la, la_h = nmea_latlon(lat, 2)
+                lo, lo_h = nmea_latlon(lon, 3)
+                fix = "{},{},{},{},{}".format(hms, la, "NS"[la_h], lo, "EW"[lo_h])
+                self.ship_logs[ship] += "".join([
+                    nmea_sentence("GPGGA,{},1,08,0.9,12.0,M,-40.0,M,,".format(fix)),
+                    nmea_sentence("GPRMC,{},A,{},10.1,93.2,{},,,A".format(
+                        hms, fix.split(",", 1)[1], self.time.strftime("%d%m%y"))),
+                    nmea_sentence("GPVTG,93.2,T,,M,10.1,N,18.7,K,A"),
+                    nmea_sentence("GPZDA,{},{},00,00".format(hms, self.time.strftime("%d,%m,%Y"))),
+                ]).encode("ascii")
+            self._cache = {}
+            return self.time
+
+    def swift_response(self, name, start=None):
+        i = self.buoys.index(name)
+        data = []
+        for n, t in enumerate(self.records):
+            if start is not None and t < start:
+                continue
+            lat, lon = self.position(i, n)
+            data.append({
+                "timestamp": t.isoformat() + "Z",
+                "lat": lat,
+                "lon": lon,
+                "wind_speed": 5. + n % 7,
+                "wave_height": 1. + 0.1 * (n % 5),
+                "voltage": None if n % 3 == 0 else 12.1,
+            })
+        return {"success": True, "buoys": [{"name": name, "data": data}]}
+
+    def glider_export(self, view):
+        i = int(view)
+        header = list(FIELDMAP)
+        lines = [",".join(header)]
+        for n, t in enumerate(self.records):
+            lat, lon = self.position(i, n)
+            values = []
+            for col in header:
+                if col in ("TimeStamp", "Created On"):
+                    values.append(t.strftime("%m/%d/%Y %H:%M:%S"))
+                elif col == "Lat (deg)":
+                    values.append("{:.6f}".format(lat))
+                elif col == "Lon (deg)":
+                    values.append("{:.6f}".format(lon))
+                elif n % 11 == 0:
+                    values.append("")
+                else:
+                    values.append("{:.2f}".format(1. + n % 13))
+            lines.append(",".join(values))
+        return "\r\n".join(lines) + "\r\n"
+
+    def fr24_feed(self, bounds=None):
+        n = len(self.records) - 1
+        t = self.records[-1].replace(tzinfo=datetime.timezone.utc).timestamp()
+        feed = {"full_count": self.platforms, "version": 4}
+        for i, registration in enumerate(self.aircraft):
+            lat, lon = self.position(i, n)
+            if bounds is not None and not (bounds[1] <= lat <= bounds[0] and bounds[2] <= lon <= bounds[3]):
+                continue
+            feed["{:08x}".format(i)] = ["{:06X}".format(i), lat, lon, 93, 15000, 250, "1234", "T-TEST1",
+                                        "DHC6", registration, int(t), "BGI", "", "", 0, 0, "", 0, ""]
+        feed["stats"] = {"total": {"ads-b": self.platforms}}
+        return feed
+
+    def response(self, path, query):
+        """
+        Return `(content_type, body)` for a GET request, body may be None for unknown paths.
+        """
+        key = (path, tuple(sorted((k, tuple(v)) for k, v in query.items())))
+        with self.lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                return cached
+            if path == "/kml":
+                start = query.get("start", [""])[0]
+                start = datetime.datetime.fromisoformat(start) if start else None
+                result = ("application/json",
+                          json.dumps(self.swift_response(query["buoy_name"][0], start)).encode("utf-8"))
+            elif path == "/pages/exportPage.aspx":
+                result = ("text/csv", self.glider_export(query["viewid"][0]).encode("utf-8"))
+            elif path == "/zones/fcgi/feed.js":
+                bounds = query.get("bounds", [""])[0]
+                bounds = [float(b) for b in bounds.split(",")] if bounds else None
+                result = ("application/json", json.dumps(self.fr24_feed(bounds)).encode("utf-8"))
+            elif path.startswith("/ship/") and path[6:-4] in self.ship_logs:
+                result = ("text/plain", bytes(self.ship_logs[path[6:-4]]))
+            else:
+                return None, None
+            self._cache[key] = result
+            return result
+
+
+class FakeSourceHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    sources = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b"<ok/>"
+        self.send_response(200)
+        self.send_header("Set-Cookie", "session=fake")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        content_type, body = self.sources.response(url.path, parse_qs(url.query, keep_blank_values=True))
+        if body is None:
+            self.send_error(404)
+            return
+        status = 200
+        headers = {"Content-Type": content_type}
+        m = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if m is not None and url.path.startswith("/ship/"):
+            start = int(m.group(1))
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(len(body)))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            headers["Content-Range"] = "bytes {}-{}/{}".format(start, len(body) - 1, len(body))
+            body = body[start:]
+            status = 206
+        else:
+            etag = '"{}"'.format(hashlib.blake2b(body, digest_size=8).hexdigest())
+            headers["ETag"] = etag
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_in_thread(sources, host="127.0.0.1", port=0):
+    """
+    Serve `sources` on a background thread, returns `(server, base_url)`.
+    """
+    handler = type("Handler", (FakeSourceHandler,), {"sources": sources})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="FakeSources", daemon=True).start()
+    return server, "http://{}:{}".format(*server.server_address)
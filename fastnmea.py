@@ -0,0 +1,137 @@
+import datetime
+from functools import reduce
+from operator import xor
+
+import pynmea2
+
+KNOTS = 1.852 / 3.6 # knots to m/s (exact)
+
+# attributes of pynmea2 sentences which are used by NMEAAssetState.update
+STATE_ATTRIBUTES = ["timestamp", "latitude", "longitude", "spd_over_grnd_kts", "true_track", "datestamp", "tzinfo"]
+
+
+def checksum_ok(sentence):
+    """
+    Check the checksum of a sentence like "$GPGGA,...*47", sentences without a checksum pass.
+    """
+    body, star, checksum = sentence.partition("*")
+    if not star:
+        return True
+    try:
+        return int(checksum[:2], 16) == reduce(xor, body[1:].encode("ascii"), 0)
+    except ValueError:
+        return False
+
+
+def parse_latlon(value, hemisphere):
+    """
+    Convert "dddmm.mmmm" and a hemisphere letter to signed decimal degrees, None if empty.
+    """
+    if not value:
+        return None
+    dot = value.find(".")
+    if dot < 0:
+        dot = len(value)
+    degrees = float(value[:dot - 2] or 0) + float(value[dot - 2:]) / 60.
+    if hemisphere in ("S", "W"):
+        degrees = -degrees
+    return degrees
+
+
+class FastNMEADecoder(object):
+    """
+    Decode the sentences needed for ship tracks (GGA, RMC, VTG, ZDA) directly into a `NMEAAssetState`.
+
+    Only the fields which end up in the state are converted, empty fields
+    leave the state untouched and sentences with a bad checksum are dropped.
+    Any other sentence is handed to pynmea2 if `fallback` is set, sentence
+    types which do not carry any state attributes are skipped after their
+    first occurrence.
+    """
+    def __init__(self, fallback=True):
+        self.fallback = fallback
+        self.errors = 0
+        self._irrelevant = set()
+        self._time_str = None
+        self._time = None
+        self._date_str = None
+        self._date = None
+
+    def _parse_time(self, s):
+        if s != self._time_str:
+            ms = s[6:]
+            self._time = datetime.time(int(s[0:2]), int(s[2:4]), int(s[4:6]),
+                                       int(float(ms) * 1000000) if ms else 0,
+                                       tzinfo=datetime.timezone.utc)
+            self._time_str = s
+        return self._time
+
+    def _parse_date(self, s):
+        if s != self._date_str:
+            self._date = datetime.date(2000 + int(s[4:6]), int(s[2:4]), int(s[0:2]))
+            self._date_str = s
+        return self._date
+
+    def decode_line(self, state, line):
+        """
+        Decode a single sentence into `state`, returns False if it was dropped.
+        """
+        if isinstance(line, bytes):
+            line = line.decode("ascii", "replace")
+        start = line.find("$")
+        if start < 0:
+            return False
+        line = line[start:].rstrip()
+        if not checksum_ok(line):
+            self.errors += 1
+            return False
+        fields = line.partition("*")[0].split(",")
+        kind = fields[0][3:]
+        try:
+            if kind == "GGA":
+                if fields[1]:
+                    state.time_of_day = self._parse_time(fields[1])
+                if fields[2] and fields[4]:
+                    state.lat = parse_latlon(fields[2], fields[3])
+                    state.lon = parse_latlon(fields[4], fields[5])
+            elif kind == "RMC":
+                if fields[1]:
+                    state.time_of_day = self._parse_time(fields[1])
+                if fields[3] and fields[5]:
+                    state.lat = parse_latlon(fields[3], fields[4])
+                    state.lon = parse_latlon(fields[5], fields[6])
+                if fields[9]:
+                    state.day = self._parse_date(fields[9])
+            elif kind == "VTG":
+                if fields[1]:
+                    state.heading = float(fields[1])
+                if fields[5]:
+                    state.ground_speed = float(fields[5]) * KNOTS
+            elif kind == "ZDA":
+                if fields[1]:
+                    state.time_of_day = self._parse_time(fields[1])
+                if fields[2] and fields[3] and fields[4]:
+                    state.day = datetime.date(int(fields[4]), int(fields[3]), int(fields[2]))
+                if fields[5] and fields[6]:
+                    # a plain fixed offset instead of pynmea2's TZInfo, which can not be pickled
+                    state.timezone = datetime.timezone(datetime.timedelta(hours=int(fields[5]),
+                                                                          minutes=int(fields[6])))
+                else:
+                    state.timezone = None
+            elif self.fallback and kind not in self._irrelevant:
+                msg = pynmea2.parse(line)
+                # pynmea2 resolves most fields in the instance's __getattr__, not on the class
+                if not any(hasattr(msg, attr) for attr in STATE_ATTRIBUTES):
+                    self._irrelevant.add(kind)
+                    return False
+                state.update(msg)
+            else:
+                return False
+        except (ValueError, TypeError, IndexError, pynmea2.ParseError):
+            self.errors += 1
+            return False
+        return True
+
+    def decode_lines(self, state, lines):
+        for line in lines:
+            self.decode_line(state, line)
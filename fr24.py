@@ -0,0 +1,210 @@
+import time
+import datetime
+import json
+import weakref
+import requests
+
+import metrics
+
+FR24_URL = "https://data-live.flightradar24.com/zones/fcgi/feed.js"
+FR24_PARAMS = {
+    "faa": 1, "satellite": 1, "mlat": 1, "flarm": 1, "adsb": 1, "gnd": 1, "air": 1, "vehicles": 1,
+    "estimated": 1, "maxage": 14400, "gliders": 1, "stats": 1, "selected": 23933062, "ems": 1,
+}
+# north, south, west, east
+FR24_BOUNDS = (15.73, 12.90, -64.55, -49.82)
+
+# registrations of HALO, the ATR and the P-3; the Twin Otter (VP-FAZ) is published by get_TwinOtter,
+# which combines the same FR24 feed with Websentinel
+AIRCRAFT = ["D-ADLR", "F-HMTO", "N43RF"]
+
+META_KEYS = ('full_count', 'version', 'stats', 'selected-aircraft')
+
+class NoSuchAircraftError(ValueError):
+    pass
+
+def parse_record(value):
+    return {
+        "time": datetime.datetime.fromtimestamp(value[10], datetime.timezone.utc),
+        "lat": float(value[1]),
+        "lon": float(value[2]),
+        "heading": float(value[3]),
+        "ground_speed": float(value[5]*0.5144),  # "<platform speed over ground, unit: m/s>",
+        "press_alt": float(value[4]),
+    #    "gps_msl_alt": "<unit: m>",
+    #    "wgs84_alt": "<altitude in WGS84 coordinates, unit: m>",
+    #    "vert_velocity": "<vertical velocity, unit: m/s>",
+    #    "type": "fixed"
+    }
+
+def index_feed(content, registrations=None):
+    """
+    Index the aircraft records of a raw FR24 feed by registration, optionally only `registrations`.
+    """
+    data = json.loads(content)
+    index = {value[9]: value for key, value in data.items()
+             if key not in META_KEYS and isinstance(value, list) and len(value) > 10}
+    if registrations is not None:
+        index = {registration: index[registration] for registration in registrations if registration in index}
+    return index
+
+class FR24_scraper(object):
+    """
+    Looks up aircraft by registration in the FlightRadar24 feed.
+
+    One `update` fetches the feed and indexes it by registration, any number
+    of aircraft are then looked up from that single response. While the
+    positions of all `tracked` aircraft are known (and not older than
+    `max_position_age` seconds), only a box of `margin` degrees around them
+    is requested instead of the whole `bounds`.
+
+    Within `importd`, all sources share one scraper per HTTP client (see
+    `shared_scraper`) and `refresh` it, so the research aircraft and the
+    Twin Otter are looked up from a single request per cycle.
+    """
+    def __init__(self, session=requests, timeout=None, url=FR24_URL, bounds=FR24_BOUNDS, tracked=(),
+                 margin=2., max_position_age=600):
+        self.session = session
+        self.timeout = timeout
+
+        self.url = url
+        self.bounds = bounds
+        self.margin = margin
+        self.max_position_age = max_position_age
+        self.tracked = set(tracked)
+        self.last_seen = {} # registration -> (monotonic time, lat, lon)
+        self.index = {}
+        self.last_update = -float("inf")
+        self._refreshing = None
+
+    def request_bounds(self):
+        now = time.monotonic()
+        positions = [self.last_seen.get(registration) for registration in self.tracked]
+        if len(positions) == 0 or any(p is None or now - p[0] > self.max_position_age for p in positions):
+            return self.bounds
+        lats = [p[1] for p in positions]
+        lons = [p[2] for p in positions]
+        return (min(90., max(lats) + self.margin), max(-90., min(lats) - self.margin),
+                max(-180., min(lons) - self.margin), min(180., max(lons) + self.margin))
+
+    def fetch(self):
+        # FR24 needs certain headers, but it seems like, they don't nee the Cookie
+        headers = {
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+            'Accept-Language': 'en-US,en;q=0.5',
+            'Cache-Control': 'max-age=0',
+            #'Cookie': '__cfduid=d5b1ed2cfbce749611b239466ffafff961579436236; FR24ID=ohvk8noejjq824gmtk7cbak34r9p06jghii4stjsd6g8s62ef5ik; _frpk=_tjhbkQEQ8KQg2czy8el-g; cookie_law_consent=1',
+            'Connection': 'keep-alive',
+            'DNT': '1',
+            'Host': 'data-live.flightradar24.com',
+            'TE': 'Trailers',
+            'Upgrade-Insecure-Requests': '1',
+            'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:72.0) Gecko/20100101 Firefox/72.0'
+        }
+        params = dict(FR24_PARAMS, bounds=",".join("{:.2f}".format(b) for b in self.request_bounds()))
+
+        res = self.session.get(self.url, params=params, headers=headers, timeout=self.timeout)
+        res.raise_for_status()
+        return res.text
+
+    def parse(self, text):
+        with metrics.parse_timer():
+            index = index_feed(text)
+        metrics.count_records(len(index))
+        self.set_index(index)
+
+    def set_index(self, index):
+        """
+        Use an index built by `index_feed` (e.g. in a worker process) for the lookups.
+        """
+        self.index = index
+        now = time.monotonic()
+        self.last_update = now
+        for registration in self.tracked:
+            value = self.index.get(registration)
+            if value is not None:
+                self.last_seen[registration] = (now, float(value[1]), float(value[2]))
+
+    def update(self):
+        self.parse(self.fetch())
+
+    def lookup(self, callsign):
+        """
+        Location of `callsign` in the last fetched feed.
+        """
+        value = self.index.get(callsign)
+        if value is None:
+            raise NoSuchAircraftError(callsign)
+        return parse_record(value)
+
+    def get_location(self, callsign):
+        self.tracked.add(callsign)
+        self.update()
+        return self.lookup(callsign)
+
+    async def _refresh(self, http):
+        text = await http.run(self.fetch)
+        self.set_index(await http.parse(index_feed, text, sorted(self.tracked), cache_key=self.url))
+        metrics.count_records(len(self.index))
+
+    async def refresh(self, http, max_age=0):
+        """
+        Fetch and index the feed (only the `tracked` aircraft) via the `poller.AsyncHttpClient` `http`.
+
+        Nothing is fetched if the index is younger than `max_age` seconds,
+        callers arriving while a fetch is running wait for that one.
+        """
+        import asyncio
+        pending = self._refreshing
+        if pending is not None and not pending.done() and pending.get_loop() is asyncio.get_running_loop():
+            await asyncio.shield(pending)
+            return
+        if time.monotonic() - self.last_update < max_age:
+            return
+        self._refreshing = asyncio.ensure_future(self._refresh(http))
+        # a caller timing out must not cancel the fetch for the others
+        await asyncio.shield(self._refreshing)
+
+_shared_scrapers = weakref.WeakKeyDictionary() # AsyncHttpClient -> {(url, bounds): FR24_scraper}
+
+def shared_scraper(http, timeout=30, url=FR24_URL, bounds=FR24_BOUNDS):
+    """
+    The scraper of the feed at `url` shared by all sources using the `poller.AsyncHttpClient` `http`.
+    """
+    scrapers = _shared_scrapers.setdefault(http, {})
+    key = (url, tuple(bounds))
+    if key not in scrapers:
+        scrapers[key] = FR24_scraper(session=http.session, timeout=timeout, url=url, bounds=bounds)
+    return scrapers[key]
+
+def get_sources(publisher, aircraft=None, interval=30, timeout=30, url=FR24_URL, bounds=FR24_BOUNDS):
+    """
+    A single source which publishes all `aircraft` (registrations) from one FR24 request per cycle.
+
+    The request is shared with the other users of `shared_scraper` (get_TwinOtter).
+    """
+    from poller import PollSource
+
+    if aircraft is None:
+        aircraft = AIRCRAFT
+
+    async def poll(http):
+        scraper = shared_scraper(http, timeout=timeout, url=url, bounds=bounds)
+        scraper.tracked.update(aircraft)
+        await scraper.refresh(http, max_age=interval / 2)
+        for registration in aircraft:
+            if registration in scraper.index:
+                publisher.publish("platform/{}/location".format(registration), scraper.lookup(registration),
+                                  retain=True)
+
+    return [PollSource("fr24", poll, interval=interval, timeout=timeout)]
+
+def _main():
+    from mqtt_utils import EUREC4AMqttPublisher
+    import poller
+
+    with EUREC4AMqttPublisher() as publisher:
+        poller.run(get_sources(publisher))
+
+if __name__ == "__main__":
+    _main()
@@ -1,29 +1,47 @@
 import datetime
 import time
-import json
+
 import requests
+import dateutil.parser as dparser
 
 import sys
 sys.path.append('~/EUREC4A_mqtt/twotter/')
 from twotter.twotter import *
 
 from mqtt_utils import EUREC4AMqttPublisher
-
-class NoSuchAircraftError(ValueError):
-    pass
+from fr24 import shared_scraper, NoSuchAircraftError
 
 class NoSuchAircraftWebsentinelError(ValueError):
     pass
 
 class Websentinel_scraper(Twotter):
+    """
+    Websentinel client which keeps its authenticated session between updates.
+
+    If fetching the positions fails (e.g. because the session expired and a
+    login page or an HTTP error comes back), it logs in again and retries once.
+    """
     def __init__(self):
         super(Websentinel_scraper, self).__init__('/home/mpim/m300408/EUREC4A_mqtt/twotter/twotter/twotter.json')
+        self._logged_in = False
 
-    def update(self):
-        self.login()
+    def _fetch_positions(self):
         self.get_pos()
-        self._close_session()
         self.parse_json()
+
+    def update(self):
+        if not self._logged_in:
+            self.login()
+            self._logged_in = True
+            self._fetch_positions()
+        else:
+            try:
+                self._fetch_positions()
+            except (requests.RequestException, ValueError, KeyError):
+                self._logged_in = False
+                self.login()
+                self._logged_in = True
+                self._fetch_positions()
         try:
             time = self.last_pos['VP-FAZ'][2]
             lat  = self.last_pos['VP-FAZ'][5]
@@ -37,62 +55,83 @@ class Websentinel_scraper(Twotter):
                 "gps_msl_alt": float(alt),
                 "heading":float(track)
                 }
-        except:
+        except (KeyError, IndexError, TypeError, ValueError):
             raise NoSuchAircraftWebsentinelError
         return location
 
-
-class FR24_scraper(object):
-    def __init__(self):
-
-        self.url = "https://data-live.flightradar24.com/zones/fcgi/feed.js?bounds=15.73,12.90,-64.55,-49.82&faa=1&satellite=1&mlat=1&flarm=1&adsb=1&gnd=1&air=1&vehicles=1&estimated=1&maxage=14400&gliders=1&stats=1&selected=23933062&ems=1"
-
-        self.update()
-
-    def update(self):
-        # FR24 needs certain headers, but it seems like, they don't nee the Cookie
-        headers = {
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Cache-Control': 'max-age=0',
-            #'Cookie': '__cfduid=d5b1ed2cfbce749611b239466ffafff961579436236; FR24ID=ohvk8noejjq824gmtk7cbak34r9p06jghii4stjsd6g8s62ef5ik; _frpk=_tjhbkQEQ8KQg2czy8el-g; cookie_law_consent=1',
-            'Connection': 'keep-alive',
-            'DNT': '1',
-            'Host': 'data-live.flightradar24.com',
-            'TE': 'Trailers',
-            'Upgrade-Insecure-Requests': '1',
-            'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:72.0) Gecko/20100101 Firefox/72.0'
-        }
-
-        res = requests.get(self.url, headers=headers)
-        res.raise_for_status()
-        self.data = json.loads(res.text)
-
-    def get_location(self, callsign):
-        self.update()
-        for key, value in self.data.items():
-            if key in ('full_count', 'version', 'stats', 'selected-aircraft'):
-                continue
-            if value[9] != callsign:
+    def close(self):
+        if self._logged_in:
+            self._close_session()
+            self._logged_in = False
+
+
+def fix_time(location):
+    """
+    Time of a location fix as an aware UTC datetime, for comparing the fixes of both sources.
+    """
+    t = location["time"]
+    if isinstance(t, str):
+        t = dparser.parse(t)
+    elif isinstance(t, (int, float)):
+        t = datetime.datetime.fromtimestamp(t, datetime.timezone.utc)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return t
+
+
+def get_sources(publisher, interval=30, timeout=60):
+    import asyncio
+    from poller import PollSource
+
+    websenti = Websentinel_scraper()
+
+    async def fr24_location(http):
+        # the feed is shared with the fr24 plugin, so both are served by one request
+        fr24 = shared_scraper(http, timeout=timeout)
+        fr24.tracked.add('VP-FAZ')
+        await fr24.refresh(http, max_age=interval / 2)
+        return fr24.lookup('VP-FAZ')
+
+    async def poll(http):
+        # query both sources at the same time and publish the newer fix
+        results = await asyncio.gather(
+            fr24_location(http),
+            http.run(websenti.update),
+            return_exceptions=True)
+        locations = []
+        for location in results:
+            if isinstance(location, NoSuchAircraftError):
+                print('NoSuchAircraftError:', location)
+                locations.append(None)
+            elif isinstance(location, NoSuchAircraftWebsentinelError):
+                print('NoSuchAircraftWebsentinelError:', location)
+                locations.append(None)
+            elif isinstance(location, Exception):
+                print('{}: {}'.format(type(location).__name__, location))
+                locations.append(None)
+            else:
+                locations.append(location)
+        fr24_fix = locations[0]
+        fixes = []
+        for location in locations:
+            if location is None:
                 continue
-
-            location = {
-                "time": datetime.datetime.fromtimestamp(value[10], datetime.timezone.utc),
-                "lat": float(value[1]),
-                "lon": float(value[2]),
-                "heading": float(value[3]),
-                "ground_speed": float(value[5]*0.5144),  # "<platform speed over ground, unit: m/s>",
-                "press_alt": float(value[4]),
-            #    "gps_msl_alt": "<unit: m>",
-            #    "wgs84_alt": "<altitude in WGS84 coordinates, unit: m>",
-            #    "vert_velocity": "<vertical velocity, unit: m/s>",
-            #    "type": "fixed"
-            }
-            return location
-
-        raise NoSuchAircraftError
-
-
+            try:
+                fixes.append((fix_time(location), location))
+            except (KeyError, TypeError, ValueError, OverflowError) as e:
+                print('unusable fix time {!r}: {}'.format(location.get('time'), e))
+        if len(fixes) > 0:
+            # on equal times, FR24 (the first source) wins
+            location = max(fixes, key=lambda fix: fix[0])[1]
+        elif fr24_fix is not None:
+            location = fr24_fix
+        else:
+            return
+        topic = 'platform/VP-FAZ/'
+        print('publish', topic)
+        publisher.publish(topic+'location', location, True)
+
+    return [PollSource('VP-FAZ', poll, interval=interval, timeout=timeout, close=websenti.close)]
 
 
 def main():
@@ -101,40 +140,10 @@ def main():
     UPDATE_INTERVAL = 30
 
     ############
+    import poller
+
     with EUREC4AMqttPublisher() as publisher:
-        fr24 = FR24_scraper()
-        websenti = Websentinel_scraper()
-        while True:
-            try:
-                last_update = datetime.datetime.utcnow()
-
-                try:
-                    location = fr24.get_location('VP-FAZ')
-                except NoSuchAircraftError as e:
-                    print('NoSuchAircraftError:', e)
-                    try:
-                        location = websenti.update()
-                        topic = 'platform/VP-FAZ/'
-                        print('publish', topic)
-                        publisher.publish(topic+'location', location, True)
-                    except NoSuchAircraftWebsentinelError as e:
-                        print('NoSuchAircraftWebsentinelError:',e)
-                    except:
-                        pass
-                else:
-                    topic = 'platform/VP-FAZ/'
-                    print('publish', topic)
-                    publisher.publish(topic+'location', location, True)
-
-                print('Last update: {}, next update in {} seconds.'.format(
-                    last_update.isoformat(), UPDATE_INTERVAL
-                ))
-
-                time.sleep(
-                    UPDATE_INTERVAL - (datetime.datetime.utcnow() - last_update).total_seconds()
-                )
-            except:
-                pass
+        poller.run(get_sources(publisher, interval=UPDATE_INTERVAL))
 
 if __name__ == '__main__':
     main()
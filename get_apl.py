@@ -1,7 +1,10 @@
-import time
 import datetime
 import requests
+import numpy as np
 from io import StringIO
+from itertools import zip_longest
+
+import metrics
 
 # must be exported VehicleParsedOutput Records filtered to the corresponding vehicle
 EXPORT_IDS = [
@@ -107,46 +110,57 @@ FIELDMAP = {
         "Ground Speed(kt)": {
             "name": "speed_over_ground",
             "parser": parse_knots,
+            "scale": 1.852 / 3.6,
         },
         "Desired Heading (deg)": {
             "name": "desired_heading",
             "parser": parse_degrees,
+            "scale": 1.,
         },
         "Float Temp(degC)": {
             "name": "device_temperature",
             "parser": parse_celsius,
+            "scale": 1.,
         },
         "Pressure Sensor Float(kPa)": {
             "name": "pressure",
             "parser": parse_kilopascal,
+            "scale": 1000.,
         },
         "Battery (Wh)": {
             "name": "battery_charge",
             "parser": parse_watt_hours,
+            "scale": 1.,
         },
         "Lat (deg)": {
             "name": "lat",
             "parser": parse_lat,
+            "scale": 1.,
         },
         "Lon (deg)": {
             "name": "lon",
             "parser": parse_lon,
+            "scale": 1.,
         },
         "Water Speed (kt/1000) WS": {
             "name": "water_speed",
             "parser": parse_milliknots,
+            "scale": 1.852 / 3.6 / 1000.,
         },
         "Water Direction": {
             "name": "water_direction",
             "parser": parse_degrees,
+            "scale": 1.,
         },
         "Current Speed (kt)": {
             "name": "speed_in_water",
             "parser": parse_knots,
+            "scale": 1.852 / 3.6,
         },
         "Current Heading (deg)": {
             "name": "heading",
             "parser": parse_degrees,
+            "scale": 1.,
         },
         "Created On": {
             "name": "dataset_time",
@@ -154,63 +168,217 @@ FIELDMAP = {
         },
 }
 
+def parse_export_rows(text):
+    lines = iter(StringIO(text))
+    header = next(lines).strip().split(",")
+    for line in lines:
+        parts = line.strip().split(",")
+        data = {}
+        for col, part in zip(header, parts):
+            try:
+                colinfo = FIELDMAP[col]
+            except KeyError:
+                continue
+            data[colinfo["name"]] = colinfo["parser"](part.strip())
+        yield data
+
+def parse_time_column(values):
+    """
+    Convert a sequence of "%m/%d/%Y %H:%M:%S" strings to datetime64[s], blanks become NaT.
+    """
+    blank = np.fromiter((len(v.strip()) == 0 for v in values), dtype=bool, count=len(values))
+    if np.any(blank):
+        values = ["1/1/1970 0:0:0" if b else v for v, b in zip(values, blank)]
+    fields = " ".join(values).replace("/", " ").replace(":", " ").split()
+    if len(fields) != 6 * len(values):
+        # irregular entries, fall back to parsing one by one
+        return np.array([np.datetime64("NaT") if b else np.datetime64(parse_time(v.strip()), "s")
+                         for v, b in zip(values, blank)], dtype="datetime64[s]")
+    fields = np.array(fields, dtype="i8").reshape(-1, 6)
+    month, day, year, hour, minute, second = fields.T
+    months = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    times = months.astype("datetime64[D]") + (day - 1).astype("timedelta64[D]")
+    times = times.astype("datetime64[s]") + (hour * 3600 + minute * 60 + second).astype("timedelta64[s]")
+    times[blank] = np.datetime64("NaT")
+    return times
+
+def parse_float_column(values, scale=1.):
+    """
+    Convert a sequence of number strings to float, blanks become NaN.
+    """
+    nan = float("nan")
+    values = np.fromiter((float(v) if v.strip() else nan for v in values),
+                         dtype="f8", count=len(values))
+    if scale != 1.:
+        values *= scale
+    return values
+
+def _fill_blanks(body):
+    body = body.replace(",,", ",nan,").replace(",,", ",nan,")
+    body = body.replace("\n,", "\nnan,").replace(",\n", ",nan\n")
+    if body.startswith(","):
+        body = "nan" + body
+    if body.endswith(","):
+        body = body + "nan"
+    return body
+
+def _load_columns(body, fields):
+    float_fields = [(i, colinfo) for i, colinfo in fields if colinfo["parser"] is not parse_time]
+    time_fields = [(i, colinfo) for i, colinfo in fields if colinfo["parser"] is parse_time]
+    columns = {}
+    if len(float_fields) > 0:
+        table = np.loadtxt(StringIO(_fill_blanks(body)), delimiter=",", comments=None, ndmin=2,
+                           usecols=[i for i, _ in float_fields])
+        for values, (_, colinfo) in zip(table.T, float_fields):
+            columns[colinfo["name"]] = values * colinfo["scale"] if colinfo["scale"] != 1. else values
+    if len(time_fields) > 0:
+        table = np.loadtxt(StringIO(body), delimiter=",", comments=None, ndmin=2, dtype=str,
+                           usecols=[i for i, _ in time_fields])
+        for values, (_, colinfo) in zip(table.T, time_fields):
+            columns[colinfo["name"]] = parse_time_column(list(values))
+    return columns
+
+def _split_columns(lines, fields):
+    rows = [line.split(",") for line in lines]
+    table = [values[:len(rows)] for values in zip_longest(*rows, fillvalue="")]
+    columns = {}
+    for i, colinfo in fields:
+        values = table[i] if i < len(table) else [""] * len(rows)
+        if colinfo["parser"] is parse_time:
+            columns[colinfo["name"]] = parse_time_column(values)
+        else:
+            columns[colinfo["name"]] = parse_float_column(values, colinfo["scale"])
+    return columns
+
+def parse_export_columns(text):
+    """
+    Parse a WGMS CSV export into a dict of NumPy arrays keyed by the FIELDMAP names.
+
+    Unit conversions are applied to whole columns and times are returned as
+    datetime64[s] (NaT for blanks).
+    """
+    lines = [line for line in text.splitlines() if line.strip() != ""]
+    header = [col.strip() for col in lines[0].split(",")]
+    fields = [(i, FIELDMAP[col]) for i, col in enumerate(header) if col in FIELDMAP]
+    lines = lines[1:]
+    if len(lines) > 0:
+        try:
+            return _load_columns("\n".join(lines), fields)
+        except ValueError:
+            # e.g. ragged rows or whitespace-only cells
+            pass
+    return _split_columns(lines, fields)
+
+def latest_row(columns, time_column="time"):
+    """
+    Return the most recent row of a columnar export as a dict, or None if there is no valid time.
+    """
+    from mqtt_utils import latest_index
+    idx = latest_index(columns[time_column])
+    if idx is None:
+        return None
+    return {name: values[idx] if values.dtype.kind == "M" else float(values[idx])
+            for name, values in columns.items()}
+
 class GliderApi(object):
-    def __init__(self, authinfo, base_url="https://apl-uw.wgms.com"):
+    def __init__(self, authinfo, base_url="https://apl-uw.wgms.com", session=None, timeout=None):
         self._base_url = base_url
+        self._timeout = timeout
         #curl -k -H "Content-Type: text/xml; charset=utf-8" --dump-header headers -H "SOAPAction:" -d @loginsoap.xml -X POST https://gliders.wgms.com/webservices/entityapi.asmx
         loginsoap = LOGINSOAP.format(**authinfo)
         headers = {
             "Content-Type": "text/xml; charset=utf-8",
             "SOAPAction": None,
         }
-        self._session = requests.Session()
+        if session is None:
+            session = requests.Session()
+        self._session = session
         res = self._session.post(
             self._base_url + "/webservices/entityapi.asmx",
             data=loginsoap,
-            headers=headers)
+            headers=headers,
+            timeout=self._timeout)
         res.raise_for_status()
 
-    def get_export(self, view, entity):
+    def fetch_export(self, view, entity):
         #http://apl-uw.wgms.com/pages/exportPage.aspx?viewid=74297&entitytype=42
         res = self._session.get(
                 self._base_url + "/pages/exportPage.aspx",
                 params={
                     "viewid": view,
                     "entitytype": entity
-                })
-        lines = iter(StringIO(res.text))
-        header = next(lines).strip().split(",")
-        for line in lines:
-            parts = line.strip().split(",")
-            data = {}
-            for col, part in zip(header, parts):
-                try:
-                    colinfo = FIELDMAP[col]
-                except KeyError:
-                    continue
-                data[colinfo["name"]] = colinfo["parser"](part.strip())
-            yield data
+                },
+                timeout=self._timeout)
+        res.raise_for_status()
+        return res.text
 
-def _main():
-    from mqtt_utils import get_config_dir, EUREC4AMqttPublisher
+    def get_export(self, view, entity):
+        return parse_export_rows(self.fetch_export(view, entity))
+
+def get_sources(publisher, config=None, interval=30, timeout=60, vehicles=None, base_url=None, track=False,
+                track_options=None):
+    """
+    Sources polling the WGMS exports of the gliders.
+
+    With `track`, the recent track of each glider is also published to
+    `platform/<id>/track` (see `track.TrackPublisher`, which gets `track_options`).
+    """
+    import asyncio
+    from poller import PollSource
+    from track import TrackPublisher
+
+    if config is None:
+        config = load_config()
+    if vehicles is None:
+        vehicles = EXPORT_IDS
+    api_kwargs = {} if base_url is None else {"base_url": base_url}
+
+    api = None
+    login_lock = asyncio.Lock()
+
+    async def get_api(http):
+        nonlocal api
+        async with login_lock:
+            if api is None:
+                api = await http.run(GliderApi, config, session=http.session, timeout=timeout, **api_kwargs)
+        return api
+
+    def make_poll(vehicle):
+        tracker = TrackPublisher(publisher, vehicle["platform_id"], **(track_options or {})) if track else None
+
+        async def poll(http):
+            api = await get_api(http)
+            text = await http.run(api.fetch_export, vehicle["wgms_record_id"], 42)
+            columns = await http.parse(parse_export_columns, text, cache_key=vehicle["platform_id"])
+            metrics.count_records(len(columns["time"]))
+            if tracker is not None:
+                tracker.update(columns["time"], columns["lat"], columns["lon"])
+            latest = latest_row(columns)
+            if latest is None:
+                return
+            publisher.publish("platform/{}/location".format(vehicle["platform_id"]),
+                {"time": latest["time"], "lat": latest["lat"], "lon": latest["lon"]},
+                retain=True)
+        return poll
+
+    return [PollSource(vehicle["platform_id"], make_poll(vehicle), interval=interval, timeout=timeout)
+            for vehicle in vehicles]
+
+def load_config():
+    from mqtt_utils import get_config_dir
     import os
     import json
     with open(os.path.join(get_config_dir(), "liquidr_gliders.json")) as configfile:
-        config = json.load(configfile)
+        return json.load(configfile)
 
-    api = GliderApi(config)
+def _main():
+    from mqtt_utils import EUREC4AMqttPublisher
+    import poller
 
+    config = load_config()
 
     with EUREC4AMqttPublisher() as publisher:
-        while True:
-            for vehicle in EXPORT_IDS:
-                entries = list(sorted(api.get_export(vehicle["wgms_record_id"], 42),
-                                      key=lambda x: x["time"]))
-                latest = entries[-1]
-                publisher.publish("platform/{}/location".format(vehicle["platform_id"]),
-                    {"time": latest["time"], "lat": latest["lat"], "lon": latest["lon"]},
-                    retain=True)
-            time.sleep(30)
+        poller.run(get_sources(publisher, config))
 
 if __name__ == "__main__":
     _main()
@@ -1,13 +1,18 @@
 import datetime
-from httptail import http_iter
-import pynmea2
+import threading
+from httptail import HttpTail
+from fastnmea import FastNMEADecoder
+
+import metrics
 
 class NMEAAssetState(object):
+    __slots__ = ["time_of_day", "lat", "lon", "ground_speed", "heading", "day", "timezone"]
+
     def __init__(self):
         self.time_of_day = None
         self.lat = None
         self.lon = None
-        self.gound_speed = None
+        self.ground_speed = None
         self.heading = None
         self.day = None
         self.timezone = None
@@ -24,7 +29,7 @@ class NMEAAssetState(object):
         try:
             tz = msg.tzinfo
             if tz.hh is not None and tz.mm is not None:
-                self.timezone = tz
+                self.timezone = datetime.timezone(tz.utcoffset(None))
             else:
                 self.timezone = None
         except AttributeError:
@@ -32,6 +37,8 @@ class NMEAAssetState(object):
 
     @property
     def timestamp(self):
+        if self.day is None or self.time_of_day is None:
+            return None
         dt = datetime.datetime.combine(self.day, self.time_of_day)
         if self.timezone is not None:
             dt = dt.replace(tzinfo=self.timezone)
@@ -40,35 +47,109 @@ class NMEAAssetState(object):
     def to_dict(self):
         res = {"time": self.timestamp}
         for var in ["lat", "lon", "ground_speed", "heading"]:
-            val = getattr(self, var, None)
+            val = getattr(self, var)
             if val is not None:
                 res[var] = val
         return res
 
     def __str__(self):
-        return "{} {} {} {} {}".format(self.timestamp, self.lat, self.lon, self.sog, self.heading)
+        return "{} {} {} {} {}".format(self.timestamp, self.lat, self.lon, self.ground_speed, self.heading)
+
+NOAA_SHIP_URL = "https://seb.noaa.gov/pub/flight/aamps_ingest/ship/{}.txt"
+
+ASSET_PLATFORM_IDS = {
+    "33RO": "RHB",
+}
+
+_local = threading.local()
+
+def decode_nmea_chunk(state, lines):
+    """
+    Fold NMEA `lines` into `state` and return it, for `workers.ParsePool`.
+
+    Each thread / worker process keeps its own decoder (and its cache of skipped sentence types).
+    """
+    decoder = getattr(_local, "decoder", None)
+    if decoder is None:
+        decoder = _local.decoder = FastNMEADecoder()
+    decoder.decode_lines(state, lines)
+    return state
+
+def get_sources(publisher, assets=None, interval=5, timeout=None, statefile="noaa_ship_tail.json",
+                publish_interval=0, url=NOAA_SHIP_URL, platform_ids=None, request_timeout=(10, 60),
+                max_interval=60):
+    """
+    Sources tailing the NMEA feeds of `assets`.
+
+    All sentences of a chunk are folded into the asset's state, which is
+    published at most once per poll and `publish_interval` seconds, and only
+    if the fix time has advanced. Each request times out after `request_timeout`
+    (connect, read) seconds.
+
+    A feed which did not grow is polled less often: the source's interval
+    doubles up to `max_interval` and goes back to the configured interval as
+    soon as new lines arrive.
+    """
+    import time
+    from poller import PollSource
+
+    if platform_ids is None:
+        platform_ids = ASSET_PLATFORM_IDS
+    if assets is None:
+        assets = list(platform_ids)
+
+    def make_poll(asset, source):
+        tail = None
+        state = NMEAAssetState()
+        last_fix_time = None
+        last_publish = -float("inf")
+        base_interval = None
+
+        async def poll(http):
+            # there is no poll timeout by default, as an abandoned poll would still move the tail;
+            # the requests themselves time out after `request_timeout`
+            nonlocal tail, state, last_fix_time, last_publish, base_interval
+            if tail is None:
+                tail = HttpTail(url.format(asset),
+                                linebreak=b"\n", session=http.session, statefile=statefile,
+                                timeout=request_timeout)
+                # importd may have overridden the interval after `get_sources`
+                base_interval = source.interval
+            lines = await http.run(tail.poll)
+            if len(lines) > 0:
+                source.interval = base_interval
+                state = await http.parse(decode_nmea_chunk, state, lines)
+                metrics.count_records(len(lines))
+                tail.commit()
+            else:
+                source.interval = max(base_interval, min(2 * source.interval, max_interval))
+
+            fix_time = state.timestamp
+            if fix_time is None or (last_fix_time is not None and fix_time <= last_fix_time):
+                return
+            now = time.monotonic()
+            if now - last_publish < publish_interval:
+                return
+            publisher.publish("platform/{}/location".format(platform_ids[asset]),
+                state.to_dict(),
+                retain=True)
+            last_fix_time = fix_time
+            last_publish = now
+        return poll
+
+    sources = []
+    for asset in assets:
+        source = PollSource(asset, None, interval=interval, timeout=timeout)
+        source.poll = make_poll(asset, source)
+        sources.append(source)
+    return sources
 
 def _main():
     from mqtt_utils import EUREC4AMqttPublisher
-
-    streamreader = pynmea2.NMEAStreamReader()
-    assets = ["33RO"]
-    sources = {asset: http_iter("https://seb.noaa.gov/pub/flight/aamps_ingest/ship/{}.txt".format(asset))
-               for asset in assets}
-    asset_states = {asset: NMEAAssetState() for asset in assets}
-    asset_platform_ids = {
-        "33RO": "RHB"
-    }
+    import poller
 
     with EUREC4AMqttPublisher() as publisher:
-        while True:
-            for asset in assets:
-                for msg in streamreader.next(next(sources[asset]).decode("ascii")):
-                    asset_states[asset].update(msg)
-
-                publisher.publish("platform/{}/location".format(asset_platform_ids[asset]),
-                    asset_states[asset].to_dict(),
-                    retain=True)
+        poller.run(get_sources(publisher))
 
 if __name__ == "__main__":
     _main()
@@ -1,8 +1,13 @@
-import time
+import json
 import requests
 import datetime
+import numpy as np
 import dateutil.parser as dparser
 
+import metrics
+
+SWIFT_URL = "http://swiftserver.apl.washington.edu/kml"
+
 BUOYS = [
     "SWIFT 16",
     "SWIFT 17",
@@ -21,9 +26,111 @@ def parse_buoy_data(d):
             del d[k]
     return d
 
-def get_swift_buoy(name, max_age=datetime.timedelta(days=10)):
-    now = datetime.datetime.utcnow()
-    start = now - max_age
+def buoy_records(res, name):
+    """
+    The raw records of buoy `name` in a decoded SWIFT server response.
+    """
+    if not res.get("success", False):
+        raise RuntimeError("unsuccessfull response")
+    buoys = [b for b in res["buoys"] if b["name"] == name]
+    if len(buoys) != 1:
+        raise ValueError("could not uniquely identify buoy \"{}\", {} results".format(name, len(buoys)))
+    return buoys[0]["data"]
+
+def parse_swift_response(res, name, since=None):
+    """
+    Extract the records of buoy `name` from a decoded SWIFT server response, sorted by time.
+    """
+    data = list(sorted(map(parse_buoy_data, buoy_records(res, name)),
+                       key=lambda x: x["time"]))
+    if since is not None:
+        data = [d for d in data if d["time"] > since]
+    return data
+
+def parse_timestamp_column(values):
+    """
+    Convert ISO 8601 UTC timestamps (with or without "Z" / "+00:00") to datetime64[us] in bulk.
+
+    Other time zones are converted one by one with dateutil.
+    """
+    values = np.array(values, dtype=str)
+    if len(values) == 0:
+        return values.astype("datetime64[us]")
+    stripped = np.char.replace(np.char.rstrip(values, "Z"), "+00:00", "")
+    # any sign left in the time of day is an offset numpy can not represent
+    times_of_day = np.char.partition(stripped, "T")[:, 2]
+    if not np.any((np.char.find(times_of_day, "+") >= 0) | (np.char.find(times_of_day, "-") >= 0)):
+        try:
+            return stripped.astype("datetime64[us]")
+        except ValueError:
+            pass
+    return np.array([dparser.parse(v).astimezone(datetime.timezone.utc).replace(tzinfo=None)
+                     for v in values], dtype="datetime64[us]")
+
+def parse_swift_columns(res, name, since=None):
+    """
+    Columnar variant of `parse_swift_response`: a dict of NumPy arrays in server order.
+
+    `time` is datetime64[us], numeric fields are float arrays with NaN for
+    missing values, other fields object arrays with None.
+    """
+    records = buoy_records(res, name)
+    keys = set()
+    for record in records:
+        keys.update(record)
+    keys.discard("timestamp")
+    columns = {"time": parse_timestamp_column([record["timestamp"] for record in records])}
+    for key in keys:
+        values = [record.get(key) for record in records]
+        try:
+            columns[key] = np.array([np.nan if v is None else v for v in values], dtype=float)
+        except (TypeError, ValueError):
+            columns[key] = np.array(values, dtype=object)
+    if since is not None:
+        newer = columns["time"] > np.datetime64(since, "us")
+        columns = {key: values[newer] for key, values in columns.items()}
+    return columns
+
+def parse_swift_content(content, name, since=None):
+    """
+    `parse_swift_columns` of a raw response body, for `workers.ParsePool`.
+    """
+    return parse_swift_columns(json.loads(content), name, since)
+
+def latest_record(columns):
+    """
+    The newest record of `parse_swift_columns` as a dict like `parse_buoy_data` returns, or None.
+    """
+    from mqtt_utils import latest_index
+    times = columns["time"]
+    idx = latest_index(times)
+    if idx is None:
+        return None
+    record = {"time": times[idx].item()}
+    for key, values in columns.items():
+        if key == "time":
+            continue
+        value = values[idx]
+        if values.dtype.kind == "f":
+            if not np.isnan(value):
+                record[key] = float(value)
+        elif value is not None:
+            record[key] = value
+    return record
+
+def fetch_swift_buoy(name, max_age=datetime.timedelta(days=10), since=None, session=requests, timeout=None,
+                     url=SWIFT_URL):
+    """
+    Fetch the decoded SWIFT server response for one buoy.
+
+    If `since` is given, only records newer than `since` are requested,
+    otherwise the last `max_age` of data is downloaded.
+    """
+    if since is None:
+        now = datetime.datetime.utcnow()
+        start = now - max_age
+    else:
+        start = since
     params = {
         "action": "kml",
         "buoy_name": name,
@@ -32,50 +139,129 @@ def get_swift_buoy(name, max_age=datetime.timedelta(days=10)):
         "format": "json",
     }
 
-    res = requests.get("http://swiftserver.apl.washington.edu/kml", params=params)
-    res = res.json()
-    if not res.get("success", False):
-        raise RuntimeError("unsuccessfull response")
-    buoys = [b for b in res["buoys"] if b["name"] == name]
-    if len(buoys) != 1:
-        raise ValueError("could not uniquely identify buoy \"{}\", {} results".format(name, len(buoys)))
-    data = list(sorted(map(parse_buoy_data, buoys[0]["data"]),
-                       key=lambda x: x["time"]))
+    return session.get(url, params=params, timeout=timeout)
 
+def get_swift_buoy(name, max_age=datetime.timedelta(days=10), since=None, session=requests, timeout=None,
+                   url=SWIFT_URL):
+    """
+    Fetch the track of a SWIFT buoy, sorted by time, see `fetch_swift_buoy`.
+    """
+    res = fetch_swift_buoy(name, max_age, since, session, timeout, url)
+    with metrics.parse_timer():
+        data = parse_swift_response(res.json(), name, since)
+    metrics.count_records(len(data))
     return data
 
+def publish_latest(publisher, buoy, latest, callback=None):
+    """
+    Publish the newest record of a buoy, `callback` gets the result of the location message.
+    """
+    publisher.publish("platform/{}/location".format(buoy),
+        {"time": latest["time"], "lat": latest["lat"], "lon": latest["lon"]},
+        retain=True, callback=callback)
+    if "wind_speed" in latest:
+        publisher.publish("platform/{}/wind".format(buoy),
+            {"time": latest["time"], "mag": latest["wind_speed"]},
+            retain=True)
+    if "wave_height" in latest:
+        publisher.publish("platform/{}/wave".format(buoy),
+            {"time": latest["time"], "height": latest["wave_height"]},
+            retain=True)
+    if "voltage" in latest:
+        publisher.publish("platform/{}/system".format(buoy),
+            {"time": latest["time"], "voltage": latest["voltage"]},
+            retain=True)
+    if "img" in latest:
+        publisher.publish("platform/{}/image".format(buoy),
+            {"time": latest["time"], "url": latest["img"]},
+            retain=True)
+
+class SwiftCursor(object):
+    """
+    High-water mark of the newest record published per buoy, persisted across restarts.
+
+    With `statefile=None` the cursor only lives in memory. `advance` may be
+    called from the publisher's network thread.
+    """
+    def __init__(self, statefile="swift_cursor.json"):
+        import threading
+        from mqtt_utils import load_state
+        self.statefile = statefile
+        self.lock = threading.Lock()
+        if statefile is None:
+            self.cursors = {}
+        else:
+            self.cursors = {buoy: dparser.parse(t)
+                            for buoy, t in load_state(statefile, {}).items()}
+
+    def get(self, buoy):
+        return self.cursors.get(buoy)
+
+    def advance(self, buoy, time):
+        from mqtt_utils import save_state
+        with self.lock:
+            if buoy in self.cursors and self.cursors[buoy] >= time:
+                return
+            self.cursors[buoy] = time
+            if self.statefile is not None:
+                save_state(self.statefile, self.cursors)
+
+def get_sources(publisher, interval=30, timeout=60, cursor=None, buoys=None, url=SWIFT_URL, track=False,
+                track_options=None):
+    """
+    Sources polling the SWIFT buoys for new records.
+
+    With `track`, the recent track of each buoy is also published to
+    `platform/<buoy>/track` (see `track.TrackPublisher`, which gets
+    `track_options`), the first poll then fetches the whole track window.
+    """
+    from poller import PollSource
+    from track import TrackPublisher
+    from mqtt_utils import FAILED
+
+    if cursor is None:
+        cursor = SwiftCursor()
+    if buoys is None:
+        buoys = BUOYS
+
+    def make_poll(buoy):
+        tracker = TrackPublisher(publisher, buoy, **(track_options or {})) if track else None
+
+        async def poll(http):
+            since = cursor.get(buoy)
+            max_age = datetime.timedelta(days=10)
+            if tracker is not None and len(tracker.buffer) == 0:
+                since = None
+                max_age = datetime.timedelta(seconds=tracker.buffer.max_age)
+            res = await http.run(fetch_swift_buoy, buoy, max_age=max_age, since=since,
+                                 session=http.session, timeout=timeout, url=url)
+            try:
+                columns = await http.parse(parse_swift_content, res.content, buoy, since, cache_key=buoy)
+            except ValueError:
+                return
+            metrics.count_records(len(columns["time"]))
+            if tracker is not None and "lat" in columns and "lon" in columns:
+                tracker.update(columns["time"], columns["lat"], columns["lon"])
+            latest = latest_record(columns)
+            if latest is None:
+                return
+
+            def on_result(topic, result):
+                # a lost record has to be requested again
+                if result != FAILED:
+                    cursor.advance(buoy, latest["time"])
+            publish_latest(publisher, buoy, latest, callback=on_result)
+        return poll
+
+    return [PollSource(buoy, make_poll(buoy), interval=interval, timeout=timeout)
+            for buoy in buoys]
 
 def _main():
     from mqtt_utils import EUREC4AMqttPublisher
+    import poller
 
     with EUREC4AMqttPublisher() as publisher:
-        while True:
-            for buoy in BUOYS:
-                try:
-                    data = get_swift_buoy(buoy)
-                    latest = data[-1]
-                except ValueError:
-                    continue
-                publisher.publish("platform/{}/location".format(buoy),
-                    {"time": latest["time"], "lat": latest["lat"], "lon": latest["lon"]},
-                    retain=True)
-                if "wind_speed" in latest:
-                    publisher.publish("platform/{}/wind".format(buoy),
-                        {"time": latest["time"], "mag": latest["wind_speed"]},
-                        retain=True)
-                if "wave_height" in latest:
-                    publisher.publish("platform/{}/wave".format(buoy),
-                        {"time": latest["time"], "height": latest["wave_height"]},
-                        retain=True)
-                if "voltage" in latest:
-                    publisher.publish("platform/{}/system".format(buoy),
-                        {"time": latest["time"], "voltage": latest["voltage"]},
-                        retain=True)
-                if "img" in latest:
-                    publisher.publish("platform/{}/image".format(buoy),
-                        {"time": latest["time"], "url": latest["img"]},
-                        retain=True)
-            time.sleep(30)
+        poller.run(get_sources(publisher))
 
 if __name__ == "__main__":
     _main()
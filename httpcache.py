@@ -0,0 +1,148 @@
+"""
+Conditional requests and content-hash caches for the shared HTTP client.
+
+`ResponseCache` remembers the validators (`ETag`, `Last-Modified`) and the
+body of the last response per URL and sends `If-None-Match` /
+`If-Modified-Since` with the next GET. A `304 Not Modified` is turned back
+into a complete response with the cached body, so callers do not have to
+care. Every response also gets
+
+- `from_cache`: the body was not transferred again (304),
+- `unchanged`: the body is byte-identical to the last one of this URL.
+
+`ParseCache` keeps the last parse result per key and reuses it while the
+content (compared by hash) and the other parse arguments stay the same.
+
+Hits and misses are counted per source in `metrics.CACHE`, together with the
+running hit ratio and the bytes that were not transferred.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import metrics
+
+
+def content_digest(content):
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+
+class _Entry(object):
+    __slots__ = ["digest", "etag", "last_modified", "content", "headers", "encoding"]
+
+    def __init__(self, digest, etag, last_modified, content, headers, encoding):
+        self.digest = digest
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content = content
+        self.headers = headers
+        self.encoding = encoding
+
+
+class ResponseCache(object):
+    """
+    Validators and bodies of the last GET responses of up to `max_entries` URLs.
+
+    Bodies are only kept if the server sent a validator, otherwise only their hash is.
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cacheable(request, stream=False):
+        return request.method == "GET" and not stream and "Range" not in request.headers
+
+    def prepare(self, request):
+        """
+        Add the conditional headers for `request`, returns its cache entry (or None).
+        """
+        with self._lock:
+            entry = self.entries.get(request.url)
+            if entry is None:
+                return None
+            self.entries.move_to_end(request.url)
+        if entry.etag is not None:
+            request.headers.setdefault("If-None-Match", entry.etag)
+        if entry.last_modified is not None:
+            request.headers.setdefault("If-Modified-Since", entry.last_modified)
+        return entry
+
+    def update(self, request, response, entry):
+        """
+        Complete a 304 response from `entry` or remember a new one, sets `from_cache` and `unchanged`.
+        """
+        response.from_cache = False
+        response.unchanged = False
+        if response.status_code == 304 and entry is not None and entry.content is not None:
+            headers = entry.headers.copy()
+            headers.update(response.headers)
+            response.headers = headers
+            response.status_code = 200
+            response.reason = "OK"
+            response.encoding = entry.encoding
+            response._content = entry.content
+            response.from_cache = True
+            response.unchanged = True
+            metrics.HTTP_CACHE_SAVED_BYTES.inc(len(entry.content), source=metrics.current_source.get())
+            metrics.cache_result("not_modified", "http")
+            return
+        if response.status_code != 200:
+            return
+        digest = content_digest(response.content)
+        response.unchanged = entry is not None and entry.digest == digest
+        metrics.cache_result("miss" if entry is None else "unchanged" if response.unchanged else "changed", "http")
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            entry = _Entry(digest, None, None, None, None, None)
+        else:
+            entry = _Entry(digest, etag, last_modified, response.content, response.headers.copy(),
+                           response.encoding)
+        with self._lock:
+            self.entries[request.url] = entry
+            self.entries.move_to_end(request.url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class ParseCache(object):
+    """
+    Last parse result per key, reused while the arguments are the same.
+
+    Strings and bytes are compared by their hash, all other arguments by `==`.
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(args):
+        return tuple(("digest", content_digest(arg)) if isinstance(arg, (bytes, str)) else arg for arg in args)
+
+    def get(self, key, fingerprint):
+        """
+        `(True, result)` if `key` was parsed from the same arguments before, otherwise `(False, None)`.
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            hit = entry is not None and entry[0] == fingerprint
+            if hit:
+                self.entries.move_to_end(key)
+        if hit:
+            metrics.cache_result("hit", "parse")
+            return True, entry[1]
+        metrics.cache_result("miss", "parse")
+        return False, None
+
+    def put(self, key, fingerprint, result):
+        with self._lock:
+            self.entries[key] = (fingerprint, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
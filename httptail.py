@@ -1,42 +1,119 @@
 import time
+import threading
 import requests
 
-def http_iter(url, throttle=5, linebreak=None):
+_state_lock = threading.Lock()
+
+class HttpTail(object):
+    """
+    Follow a document which is accessible via HTTP and only ever appended to.
+
+    The HTTP server should support bytewise Range requests. A keep-alive
+    session is reused for all requests and conditional requests
+    (If-None-Match / If-Modified-Since) are used, so polls of an unchanged
+    document are cheap.
+
+    If `statefile` is given, the byte offset and the partial line remainder
+    are stored there (keyed by URL) after each chunk is consumed, so the tail
+    resumes where it left off after a restart.
+
+    `timeout` is the requests timeout (seconds or `(connect, read)`) of each
+    request, so a stalled connection can not block a poll forever.
+    """
+    def __init__(self, url, linebreak=None, session=None, statefile=None, timeout=(10, 60)):
+        self.url = url
+        self.linebreak = linebreak
+        self.timeout = timeout
+        self.session = session if session is not None else requests.Session()
+        self.statefile = statefile
+        self.pos = 0
+        self.remainder = b''
+        self.etag = None
+        self.last_modified = None
+        if statefile is not None:
+            self._load()
+
+    def _load(self):
+        from mqtt_utils import load_state
+        state = load_state(self.statefile, {}).get(self.url)
+        if state is not None:
+            self.pos = state["pos"]
+            self.remainder = state["remainder"].encode("latin-1")
+
+    def commit(self):
+        """
+        Persist the current position, call this once the last chunk has been processed.
+        """
+        if self.statefile is None:
+            return
+        from mqtt_utils import load_state, save_state
+        with _state_lock:
+            state = load_state(self.statefile, {})
+            state[self.url] = {"pos": self.pos, "remainder": self.remainder.decode("latin-1")}
+            save_state(self.statefile, state)
+
+    def poll(self):
+        """
+        Do a single request and return a list of new chunks (or lines if `linebreak` is set).
+
+        An empty list is returned if the document has not grown.
+        """
+        headers = {"Range": "bytes={}-".format(self.pos)}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        res = self.session.get(self.url, headers=headers, timeout=self.timeout)
+        if res.status_code == requests.codes.not_modified:
+            return []
+        elif res.status_code == requests.codes.ok:
+            if self.pos != 0:
+                print("WARNING: server does not support range requests")
+            new_data = res.content[self.pos:]
+        elif res.status_code == requests.codes.partial_content:
+            new_data = res.content
+        elif res.status_code == requests.codes.requested_range_not_satisfiable:
+            # "Content-Range: bytes */<size>", if the document shrank it has been replaced
+            size = res.headers.get("Content-Range", "").rpartition("/")[2]
+            if size.isdigit() and int(size) < self.pos:
+                print("WARNING: {} has been truncated, restarting from the beginning".format(self.url))
+                self.pos = 0
+                self.remainder = b''
+            return []
+        else:
+            res.raise_for_status()
+            raise RuntimeError("unexpected response {} for {}".format(res.status_code, self.url))
+        self.etag = res.headers.get("ETag", None)
+        self.last_modified = res.headers.get("Last-Modified", None)
+        self.pos += len(new_data)
+        if len(new_data) == 0:
+            return []
+        if self.linebreak is not None:
+            lines = new_data.split(self.linebreak)
+            lines[0] = self.remainder + lines[0]
+            self.remainder = lines[-1]
+            return lines[:-1]
+        else:
+            return [new_data]
+
+
+def http_iter(url, throttle=5, linebreak=None, session=None, statefile=None):
     """
     Iterate over chunks of a document which is accessible via HTTP.
 
     The HTTP server should support bytewise Range requests.
     Furthermore, `http_iter` assumes that the document is only appended but
-    never modified otherwise.
+    never modified otherwise. See `HttpTail` for `session` and `statefile`.
     """
-    pos = 0
+    tail = HttpTail(url, linebreak=linebreak, session=session, statefile=statefile)
     last_request_time = 0
-    remainder = b''
     while True:
-        headers = {"Range": "bytes={}-".format(pos)}
         dt = time.time() - last_request_time
         if dt < throttle:
             time.sleep(max(0, throttle - dt))
-        res = requests.get(url, headers=headers)
+        chunks = tail.poll()
         last_request_time = time.time()
-        if res.status_code == requests.codes.ok:
-            if pos != 0:
-                print("WARNING: server does not support range requests")
-            new_data = res.content[pos:]
-        elif res.status_code == requests.codes.partial_content:
-            new_data = res.content
-        elif res.status_code == requests.codes.requested_range_not_satisfiable:
-            continue
-        else:
-            res.raise_for_status()
-            break
-        pos += len(new_data)
-        if linebreak is not None:
-            lines = new_data.split(linebreak)
-            lines[0] = remainder + lines[0]
-            remainder = lines[-1]
-            lines = lines[:-1]
-            for line in lines:
-                yield line
-        else:
-            yield new_data
+        for chunk in chunks:
+            yield chunk
+        if len(chunks) > 0:
+            tail.commit()
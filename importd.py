@@ -0,0 +1,116 @@
+"""
+Run several importers in one process which shares a single MQTT connection.
+
+Importers are plugin modules which provide a function
+`get_sources(publisher, **options)` returning a list of `poller.PollSource`.
+The plugins to load are given on the command line or in `importd.json` in the
+config directory, e.g.:
+
+    {
+        "plugins": [
+            {"module": "get_swift", "interval": 30, "jitter": 5},
+            {"module": "get_apl", "interval": 60},
+            {"module": "get_noaa_ship"},
+            {"module": "get_TwinOtter", "options": {"timeout": 30}}
+        ]
+    }
+
+With `--metrics-port` the metrics of all sources are served in the Prometheus
+text format, with `--status-interval` they are also published periodically to
+`status/<name>/metrics`.
+"""
+import importlib
+import traceback
+import json
+import os
+
+from mqtt_utils import get_config_dir, EUREC4AMqttPublisher
+import poller
+import metrics
+
+DEFAULT_PLUGINS = ["get_swift", "get_apl", "get_noaa_ship", "get_TwinOtter", "fr24"]
+
+def load_config(path=None):
+    if path is None:
+        path = os.path.join(get_config_dir(), "importd.json")
+        if not os.path.exists(path):
+            return {"plugins": [{"module": module} for module in DEFAULT_PLUGINS]}
+    with open(path) as configfile:
+        return json.load(configfile)
+
+def load_sources(publisher, plugins):
+    """
+    Import all plugin modules and collect their sources.
+
+    `interval` and `jitter` from the plugin config override the defaults of
+    the plugin's sources, `options` are passed on to `get_sources`.
+    """
+    sources = []
+    for plugin in plugins:
+        try:
+            module = importlib.import_module(plugin["module"])
+        except ImportError as e:
+            print("could not load plugin {}: {}".format(plugin["module"], e))
+            continue
+        try:
+            plugin_sources = module.get_sources(publisher, **plugin.get("options", {}))
+        except Exception:
+            # e.g. missing credentials of one plugin must not stop the others
+            print("could not set up plugin {}".format(plugin["module"]))
+            traceback.print_exc()
+            continue
+        for source in plugin_sources:
+            source.name = "{}:{}".format(plugin["module"], source.name)
+            if "interval" in plugin:
+                source.interval = plugin["interval"]
+            if "jitter" in plugin:
+                source.jitter = plugin["jitter"]
+        print("loaded {} sources from {}".format(len(plugin_sources), plugin["module"]))
+        sources += plugin_sources
+    return sources
+
+def status_source(publisher, name, interval):
+    async def poll(http):
+        metrics.publish_status(publisher, name)
+    return poller.PollSource("status", poll, interval=interval)
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description="run many importers sharing one MQTT connection")
+    parser.add_argument("plugins", nargs="*", help="plugin modules to load (default: from importd.json)")
+    parser.add_argument("-c", "--config", default=None, help="path to importd config file")
+    parser.add_argument("--jitter", type=float, default=None, help="default jitter for all sources in seconds")
+    parser.add_argument("--parse-workers", type=int, default=0,
+                        help="parse responses in this many worker processes (default: in this process)")
+    parser.add_argument("--no-http-cache", dest="http_cache", action="store_false",
+                        help="always download and parse complete responses")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve Prometheus metrics on this port")
+    parser.add_argument("--status-interval", type=float, default=None,
+                        help="publish metrics to status/<name>/metrics every N seconds")
+    parser.add_argument("--name", default="importd", help="name used in status topics")
+    parser.add_argument("--quiet", action="store_true", help="do not print published messages")
+    parser.add_argument("--outbox", default=None,
+                        help="journal file for messages which can not be sent while the broker is unreachable")
+    args = parser.parse_args()
+
+    if len(args.plugins) > 0:
+        plugins = [{"module": module} for module in args.plugins]
+    else:
+        plugins = load_config(args.config)["plugins"]
+    if args.jitter is not None:
+        for plugin in plugins:
+            plugin.setdefault("jitter", args.jitter)
+
+    if args.metrics_port is not None or args.status_interval is not None:
+        metrics.enable()
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+
+    with EUREC4AMqttPublisher(outbox=args.outbox, verbose=not args.quiet) as publisher:
+        sources = load_sources(publisher, plugins)
+        if args.status_interval is not None:
+            sources.append(status_source(publisher, args.name, args.status_interval))
+        poller.run(sources, parse_workers=args.parse_workers, cache=args.http_cache)
+
+if __name__ == "__main__":
+    _main()
@@ -1,20 +1,53 @@
 import datetime
-from mqtt_utils import get_mqtt_client
+import threading
+import time
+from mqtt_utils import get_mqtt_client, get_mqtt_config
 
 def _main():
-    import sys
+    import argparse
+    parser = argparse.ArgumentParser(description="log all MQTT messages")
+    parser.add_argument("logfile", nargs="?", help="text log file to append to")
+    parser.add_argument("--archive", metavar="DIRECTORY", default=None,
+                        help="write a rotating binary archive to DIRECTORY instead of a text log")
+    parser.add_argument("--compression", choices=["gzip", "zstd"], default=None)
+    parser.add_argument("--max-bytes", type=int, default=256 * 1024 * 1024,
+                        help="rotate archive files larger than this")
+    parser.add_argument("--rotate-interval", type=float, default=24 * 3600,
+                        help="rotate archive files older than this (seconds)")
+    parser.add_argument("--queue-size", type=int, default=100000)
+    parser.add_argument("--stats-interval", type=float, default=60,
+                        help="print archive counters every this many seconds")
+    args = parser.parse_args()
+    if (args.logfile is None) == (args.archive is None):
+        parser.error("either a logfile or --archive must be given")
+
     client = get_mqtt_client()
 
-    logfile = open(sys.argv[1], "a")
+    if args.archive is not None:
+        from archive import ArchiveWriter
+        writer = ArchiveWriter(args.archive, compression=args.compression, max_bytes=args.max_bytes,
+                               rotate_interval=args.rotate_interval, queue_size=args.queue_size)
+
+        def on_message(client, userdata, msg):
+            writer.put(msg.topic, msg.payload)
+
+        def report():
+            while True:
+                time.sleep(args.stats_interval)
+                print("ARCHIVE: {}".format(" ".join("{}={}".format(k, v) for k, v in writer.stats().items())))
+        threading.Thread(target=report, daemon=True).start()
+    else:
+        logfile = open(args.logfile, "a")
+
+        def on_message(client, userdata, msg):
+            now = datetime.datetime.utcnow()
+            logfile.write("{} {} {}\n".format(now.isoformat(), msg.topic, msg.payload))
 
-    def on_connect(client, userdata, flags, rc):
+    def on_connect(client, userdata, flags, rc, properties=None):
         print("MQTT: connected with result code {}".format(rc))
         client.subscribe("#")
-    def on_disconnect(client, userdata, rc):
+    def on_disconnect(client, userdata, rc, properties=None):
         print("MQTT: disonnected with result code {}".format(rc))
-    def on_message(client, userdata, msg):
-        now = datetime.datetime.utcnow()
-        logfile.write("{} {} {}\n".format(now.isoformat(), msg.topic, msg.payload))
     def on_log(client, userdata, level, buf):
         print("#LOG: {} {}".format(level, buf))
 
@@ -22,8 +55,16 @@ def _main():
     client.on_disconnect = on_disconnect
     client.on_message = on_message
     #client.on_log = on_log
-    print("initial connect: {}".format(client.connect("mqtt.eurec4a.eu", 8883, 60)))
-    client.loop_forever()
+    config = get_mqtt_config()
+    print("initial connect: {}".format(client.connect(config["host"], config["port"], 60)))
+    try:
+        client.loop_forever()
+    finally:
+        # write the last batch and close the archive file
+        if args.archive is not None:
+            writer.close()
+        else:
+            logfile.close()
 
 if __name__ == "__main__":
     _main()
@@ -0,0 +1,294 @@
+"""
+Lightweight counters, gauges and histograms for the importers.
+
+All metrics live in `REGISTRY`, which is disabled by default: every update
+then returns after a single attribute check. Call `enable()` to start
+collecting. `render()` produces the Prometheus text format, `serve()` exposes
+it over HTTP and `snapshot()` returns a JSON-friendly dict, e.g. for
+periodic `status/<name>/metrics` MQTT messages.
+
+The `source` label of HTTP and parse metrics is taken from `current_source`,
+which `poller` sets for each polling task.
+"""
+import time
+import datetime
+import threading
+import contextvars
+
+import numpy as np
+
+current_source = contextvars.ContextVar("current_source", default="")
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+AGE_BUCKETS = (1., 5., 15., 30., 60., 120., 300., 600., 1800., 3600., 3 * 3600., 12 * 3600., 86400.)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for k, v in pairs) + "}"
+
+
+class Registry(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.registry = registry if registry is not None else REGISTRY
+        self.values = {}
+        self._lock = threading.Lock()
+        self.registry.register(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        for key, value in self.values.items():
+            yield "{}{} {}".format(self.name, _format_labels(self.labelnames, key), value)
+
+    def snapshot(self):
+        return {",".join(key): value for key, value in self.values.items()}
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = value
+
+    render = Counter.render
+    snapshot = Counter.snapshot
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super(Histogram, self).__init__(name, help, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0., 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        if not self.registry.enabled:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def render(self):
+        for key, (counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield "{}_bucket{} {}".format(self.name, _format_labels(self.labelnames, key, [("le", bound)]),
+                                              bucket_count)
+            yield "{}_bucket{} {}".format(self.name, _format_labels(self.labelnames, key, [("le", "+Inf")]), count)
+            yield "{}_sum{} {}".format(self.name, _format_labels(self.labelnames, key), total)
+            yield "{}_count{} {}".format(self.name, _format_labels(self.labelnames, key), count)
+
+    def snapshot(self):
+        return {",".join(key): {"count": count, "mean": total / count if count else None}
+                for key, (_, total, count) in self.values.items()}
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = Histogram("importer_http_request_seconds", "duration of HTTP requests", ["source"])
+HTTP_RESPONSE_BYTES = Counter("importer_http_response_bytes_total", "bytes received over HTTP", ["source"])
+HTTP_ERRORS = Counter("importer_http_errors_total", "failed HTTP requests", ["source"])
+PARSE_SECONDS = Histogram("importer_parse_seconds", "time spent parsing responses", ["source"])
+PARSED_RECORDS = Counter("importer_parsed_records_total", "records produced by parsers", ["source"])
+POLL_ERRORS = Counter("importer_poll_errors_total", "failed or timed out polls", ["source", "kind"])
+DEDUP = Counter("importer_dedup_total", "deduplicator decisions", ["result"])
+DEADBAND_SUPPRESSED = Counter("importer_deadband_suppressed_total", "messages dropped by the dead-band filter")
+PUBLISHED = Counter("importer_published_total", "messages handed to the MQTT client")
+PUBLISH_ACKED = Counter("importer_publish_acked_total", "messages acknowledged by the broker (QoS 0: written)")
+PUBLISH_INFLIGHT = Gauge("importer_publish_inflight", "messages handed to the MQTT client and not yet acknowledged")
+PUBLISH_QUEUE = Gauge("importer_publish_queue_depth", "messages waiting in the MQTT client")
+SCHEDULER_DEFERRED = Counter("importer_scheduler_deferred_total", "messages delayed by rate limits")
+SCHEDULER_SUPERSEDED = Counter("importer_scheduler_superseded_total",
+                               "delayed messages replaced by a newer one of the same topic")
+OUTBOX_PENDING = Gauge("importer_outbox_pending", "messages waiting in the disk outbox")
+OUTBOX_DROPPED = Counter("importer_outbox_dropped_total", "messages dropped because the outbox was full")
+CACHE = Counter("importer_cache_total", "HTTP (not_modified / unchanged / changed / miss) and parse (hit / miss) cache results",
+                ["source", "cache", "result"])
+CACHE_HIT_RATIO = Gauge("importer_cache_hit_ratio", "share of cache lookups which avoided a transfer or a parse",
+                        ["source", "cache"])
+HTTP_CACHE_SAVED_BYTES = Counter("importer_http_cache_saved_bytes_total", "bytes not transferred thanks to 304 responses",
+                                 ["source"])
+BROKER_CONNECTED = Gauge("importer_broker_connected", "1 if connected to the broker")
+DATA_AGE = Histogram("importer_data_age_seconds", "age of published data (source time vs. now)",
+                     buckets=AGE_BUCKETS)
+LAST_DATA_AGE = Gauge("importer_last_data_age_seconds", "age of the last published data per topic", ["topic"])
+
+
+def enable(enabled=True):
+    REGISTRY.enabled = enabled
+
+
+def parse_timer():
+    """
+    Context manager timing a parse step of the current source.
+    """
+    return PARSE_SECONDS.time(source=current_source.get())
+
+
+def count_records(n):
+    PARSED_RECORDS.inc(n, source=current_source.get())
+
+
+def cache_result(result, cache):
+    """
+    Count a cache lookup of the current source and update its hit ratio.
+
+    Every result but `changed` and `miss` counts as a hit.
+    """
+    if not REGISTRY.enabled:
+        return
+    source = current_source.get()
+    CACHE.inc(source=source, cache=cache, result=result)
+    with CACHE._lock:
+        counts = {key[2]: value for key, value in CACHE.values.items() if key[:2] == (source, cache)}
+    total = sum(counts.values())
+    misses = counts.get("changed", 0) + counts.get("miss", 0)
+    CACHE_HIT_RATIO.set((total - misses) / total, source=source, cache=cache)
+
+
+def data_age(t):
+    """
+    Seconds between a source timestamp (naive datetimes are UTC) and now, None for unknown types.
+    """
+    if isinstance(t, np.datetime64):
+        return (np.datetime64(datetime.datetime.utcnow()) - t) / np.timedelta64(1, "s")
+    if isinstance(t, datetime.datetime):
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=datetime.timezone.utc)
+        return (datetime.datetime.now(datetime.timezone.utc) - t).total_seconds()
+    return None
+
+
+def observe_data_age(topic, data):
+    if not REGISTRY.enabled or not isinstance(data, dict) or topic.startswith("status/"):
+        return
+    age = data_age(data.get("time"))
+    if age is not None:
+        DATA_AGE.observe(age)
+        LAST_DATA_AGE.set(age, topic=topic)
+
+
+def render(registry=None):
+    registry = registry if registry is not None else REGISTRY
+    lines = []
+    for metric in registry.metrics:
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        with metric._lock:
+            lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def snapshot(registry=None):
+    registry = registry if registry is not None else REGISTRY
+    result = {}
+    for metric in registry.metrics:
+        with metric._lock:
+            if metric.values:
+                result[metric.name] = metric.snapshot()
+    return result
+
+
+def serve(port, host="", registry=None):
+    """
+    Serve the Prometheus text format on http://host:port/metrics from a background thread.
+    """
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = render(registry).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def publish_status(publisher, name):
+    """
+    Publish a snapshot of all metrics to the retained topic `status/<name>/metrics`.
+    """
+    return publisher.publish("status/{}/metrics".format(name),
+                             {"time": datetime.datetime.utcnow(), "metrics": snapshot()},
+                             retain=True)
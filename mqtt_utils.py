@@ -3,6 +3,11 @@ import time
 import datetime
 import json
 import ssl
+import hashlib
+import threading
+from collections import OrderedDict, deque
+
+import metrics
 
 def json_default(obj):
     if isinstance(obj, np.datetime64):
@@ -23,68 +28,551 @@ def get_config_dir():
     else:
         raise RuntimeError("could not find config path")
 
+def get_state_dir():
+    import os
+    if "EUREC4A_STATE" in os.environ:
+        return os.path.join(os.environ["EUREC4A_STATE"])
+    elif "XDG_STATE_HOME" in os.environ:
+        return os.path.join(os.environ["XDG_STATE_HOME"], "eurec4a")
+    elif "HOME" in os.environ:
+        return os.path.join(os.environ["HOME"], ".local", "state", "eurec4a")
+    else:
+        raise RuntimeError("could not find state path")
+
+def load_state(name, default=None):
+    """
+    Load a small JSON state file (e.g. polling cursors) from the state directory.
+    """
+    import os
+    try:
+        with open(os.path.join(get_state_dir(), name)) as statefile:
+            return json.load(statefile)
+    except FileNotFoundError:
+        return default
+
+def save_state(name, state):
+    """
+    Atomically replace a JSON state file in the state directory.
+    """
+    import os
+    state_dir = get_state_dir()
+    os.makedirs(state_dir, exist_ok=True)
+    path = os.path.join(state_dir, name)
+    with open(path + ".tmp", "w") as statefile:
+        json.dump(state, statefile, default=json_default)
+    os.replace(path + ".tmp", path)
+
+
+def latest_index(times):
+    """
+    Index of the newest time in a datetime64 array, None if it is empty or all NaT.
+    """
+    if len(times) == 0:
+        return None
+    # NaT is the smallest int64, so it is never picked unless all times are NaT
+    idx = int(np.argmax(times.view("i8")))
+    if np.isnat(times[idx]):
+        return None
+    return idx
+
+
+def message_digest(message):
+    """
+    Compact hash of the canonical JSON serialization of a message.
+
+    Encoded payloads (bytes) are hashed as they are.
+    """
+    if not isinstance(message, (bytes, bytearray)):
+        message = json.dumps(message, default=json_default, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.blake2b(message, digest_size=8).digest()
+
 
 class MQTTDeduplicator(object):
-    def __init__(self, expiration_time = np.timedelta64(15, "m")):
-        self.expiration_time = expiration_time
-        self.messages = {}
+    """
+    Remembers a digest of the last message per topic to drop exact repeats.
+
+    Repeats are let through again after `expiration_time`. At most
+    `max_topics` topics are tracked, the least recently refreshed topic is
+    evicted first.
+    """
+    def __init__(self, expiration_time = np.timedelta64(15, "m"), max_topics=10000):
+        if isinstance(expiration_time, np.timedelta64):
+            expiration_time = expiration_time / np.timedelta64(1, "s")
+        self.expiration_time = float(expiration_time)
+        self.max_topics = max_topics
+        self.messages = OrderedDict()
+        self._lock = threading.Lock() # `forget` is also called from the client's network thread
+
+    def _evict(self, now):
+        messages = self.messages
+        while messages:
+            topic, (last_update, _) = next(iter(messages.items()))
+            if len(messages) > self.max_topics or last_update + self.expiration_time < now:
+                del messages[topic]
+            else:
+                break
 
     def is_new(self, topic, message):
-        now = np.datetime64("now")
-        if not topic in self.messages:
-            self.messages[topic] = (now, message)
-            return True
-        last_update, last_message = self.messages[topic]
-        if last_update + self.expiration_time < now:
-            self.messages[topic] = (now, message)
-            return True
-        if last_message != message:
-            self.messages[topic] = (now, message)
-            return True
-        return False
+        now = time.monotonic()
+        digest = message_digest(message)
+        with self._lock:
+            entry = self.messages.get(topic)
+            if entry is not None and entry[1] == digest and entry[0] + self.expiration_time >= now:
+                return False
+            self.messages[topic] = (now, digest)
+            self.messages.move_to_end(topic)
+            self._evict(now)
+        return True
+
+    def forget(self, topic):
+        """
+        Let the next message of `topic` through, e.g. after the last one could not be sent.
+        """
+        with self._lock:
+            self.messages.pop(topic, None)
+
+    def __len__(self):
+        return len(self.messages)
+
+# results passed to publish callbacks
+ACKED = "acked"         # acknowledged by the broker (QoS 1 / 2) or written to the socket (QoS 0)
+DEFERRED = "deferred"   # held back by the scheduler or put into the outbox, sent later
+DROPPED = "dropped"     # duplicate or within the dead-band, not sent
+FAILED = "failed"       # could not be handed to the client (QoS 0 while disconnected, window and queue full)
+
+MQTT_DEFAULTS = {
+    "host": "mqtt.eurec4a.eu",
+    "port": 8883,
+    "tls": True,
+}
+
+def get_mqtt_config():
+    """
+    Broker settings from `mqtt_import.json` in the config directory.
+
+    Besides `username` and `password`, the file may set `host`, `port` and
+    `tls` (e.g. to use a local test broker), see `MQTT_DEFAULTS`.
+    """
+    import os
+    config = dict(MQTT_DEFAULTS)
+    try:
+        with open(os.path.join(get_config_dir(), "mqtt_import.json")) as configfile:
+            config.update(json.load(configfile))
+    except FileNotFoundError:
+        pass
+    return config
 
-def get_mqtt_client(username=None, password=None):
+def get_mqtt_client(username=None, password=None, tls=None, mqtt_version=None):
     import paho.mqtt.client as mqtt
     import os
-    client = mqtt.Client()
-    client.tls_set(ca_certs=os.path.join(os.path.dirname(__file__), "trustid-x3-root.pem.txt"),
-        tls_version=ssl.PROTOCOL_TLSv1_2)
+    config = get_mqtt_config()
+    if mqtt_version is None:
+        mqtt_version = config.get("mqtt_version", 3)
+    client = mqtt.Client(protocol=mqtt.MQTTv5 if mqtt_version == 5 else mqtt.MQTTv311)
+    if tls is None:
+        tls = config["tls"]
+    if tls:
+        client.tls_set(ca_certs=os.path.join(os.path.dirname(__file__), "trustid-x3-root.pem.txt"),
+            tls_version=ssl.PROTOCOL_TLSv1_2)
     if username is None and password is None:
-        config_dir = get_config_dir()
-        with open(os.path.join(config_dir, "mqtt_import.json")) as configfile:
-            config = json.load(configfile)
-        username = config["username"]
-        password = config["password"]
-    client.username_pw_set(username, password)
+        username = config.get("username")
+        password = config.get("password")
+    if username is not None:
+        client.username_pw_set(username, password)
     return client
 
 class EUREC4AMqttPublisher(object):
-    def __init__(self, username=None, password=None, deduplicate=True):
-        self.client = get_mqtt_client(username, password)
+    """
+    Publishes messages to the EUREC4A broker, dropping repeated messages.
+
+    Messages are encoded once by `encoder` (an `encoders` instance or name,
+    by default the `encoding` from `mqtt_import.json` or JSON), the encoded
+    bytes are used for deduplication, publishing and the optional `archive`
+    (an `archive.ArchiveWriter`). On MQTT 5 connections (`mqtt_version` in
+    `mqtt_import.json`) the content type is sent with every message, otherwise
+    non-JSON encodings are announced once per topic on `encoding/<topic>`.
+
+    With an `outbox` (an `outbox.Outbox` or a path to its journal), messages
+    which can not be sent because the broker is unreachable, or because more
+    than `max_queued` messages are already waiting in the client, are stored
+    on disk and sent once the connection is back.
+
+    A `scheduler.PublishScheduler` (by default built from the `schedule`
+    section of `mqtt_import.json`, if any) limits the rate of messages and
+    bytes, messages above the limits are sent later.
+
+    A `deadband.DeadbandFilter` (by default built from the `deadband`
+    section of `mqtt_import.json`, if any) drops messages which did not
+    change significantly since the last published one.
+
+    Messages are sent with `qos` (by default `qos` from `mqtt_import.json`
+    or 0). At most `max_inflight` messages are handed to the client without
+    being acknowledged (for QoS 0: written to the socket). Further messages
+    go to the outbox if there is one, otherwise up to `max_queued` of them
+    wait in memory and are handed over as acknowledgements come in; `publish`
+    never blocks. `publish` and `publish_many` take a callback,
+    `publish_async` returns an awaitable with the result (`ACKED`,
+    `DEFERRED`, `DROPPED` or `FAILED`). On exit, the publisher waits up to
+    `flush_timeout` seconds for outstanding acknowledgements.
+
+    With `verbose`, published messages are printed, at most `log_rate` per second.
+    """
+    def __init__(self, username=None, password=None, deduplicate=True, host=None, port=None, tls=None,
+                 verbose=True, outbox=None, max_queued=1000, scheduler=None,
+                 deadband=None, encoder=None, archive=None, qos=None, max_inflight=100, flush_timeout=10,
+                 connect_timeout=10, log_rate=10):
+        config = get_mqtt_config()
+        self.host = host if host is not None else config["host"]
+        self.port = port if port is not None else config["port"]
+        mqtt_version = config.get("mqtt_version", 3)
+        self.client = get_mqtt_client(username, password, tls, mqtt_version)
+        self.verbose = verbose
+        if log_rate is not None:
+            from scheduler import TokenBucket
+            self._log_bucket = TokenBucket(log_rate, max(1., log_rate))
+        else:
+            self._log_bucket = None
+        self._log_skipped = 0
+        self.qos = qos if qos is not None else config.get("qos", 0)
+        self.max_inflight = max_inflight
+        self.flush_timeout = flush_timeout
+        self.connect_timeout = connect_timeout
+        if max_inflight is not None:
+            self.client.max_inflight_messages_set(max_inflight)
+        self._inflight = {} # mid -> (topic, callback)
+        self._acked_early = set() # mids acknowledged before they were tracked
+        self._sending = 0 # window slots reserved by messages being handed to the client
+        self._waiting = deque() # (topic, payload, retain, callback) waiting for room in the window
+        self._window = threading.Condition()
         self._is_connected = False
+        self._connected = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
         if deduplicate:
             self.deduplicator = MQTTDeduplicator()
         else:
             self.deduplicator = None
+        if isinstance(outbox, str):
+            from outbox import Outbox
+            outbox = Outbox(outbox)
+        self.outbox = outbox
+        self.max_queued = max_queued
+        if scheduler is None and "schedule" in config:
+            from scheduler import PublishScheduler
+            scheduler = PublishScheduler.from_config(config["schedule"])
+        self.scheduler = scheduler
+        if deadband is None and "deadband" in config:
+            from deadband import DeadbandFilter
+            deadband = DeadbandFilter.from_config(config["deadband"])
+        self.deadband = deadband
+        from encoders import get_encoder
+        if encoder is None:
+            encoder = config.get("encoding", "json")
+        if isinstance(encoder, str):
+            encoder = get_encoder(encoder)
+        self.encoder = encoder
+        self.archive = archive
+        self._properties = None
+        self._announced = None
+        if mqtt_version == 5:
+            from paho.mqtt.properties import Properties
+            from paho.mqtt.packettypes import PacketTypes
+            self._properties = Properties(PacketTypes.PUBLISH)
+            self._properties.ContentType = encoder.content_type
+        elif encoder.content_type != "application/json":
+            self._announced = set()
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        self._is_connected = rc == 0
+        if self._is_connected:
+            self._connected.set()
+        metrics.BROKER_CONNECTED.set(int(self._is_connected))
+        if self._is_connected:
+            self._release()
+
+    def _on_disconnect(self, client, userdata, rc, properties=None):
+        self._is_connected = False
+        self._connected.clear()
+        metrics.BROKER_CONNECTED.set(0)
+        lost = []
+        with self._window:
+            if self.qos == 0:
+                # unsent QoS 0 messages are discarded by the client on reconnect
+                lost = list(self._inflight.values())
+                self._inflight.clear()
+            # late acks of dropped mids must not match new messages once the mids wrap around
+            self._acked_early.clear()
+            self._window.notify_all()
+        for topic, callback in lost:
+            self._failed(topic, callback)
+
+    @staticmethod
+    def _notify(callback, topic, result):
+        if callback is None:
+            return
+        try:
+            callback(topic, result)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+    def _failed(self, topic, callback):
+        # a retry of the same message must not be dropped as a repeat
+        if self.deduplicator is not None:
+            self.deduplicator.forget(topic)
+        if self.deadband is not None:
+            self.deadband.forget(topic)
+        self._notify(callback, topic, FAILED)
+
+    def _acked(self, topic, callback):
+        metrics.PUBLISH_ACKED.inc()
+        if metrics.REGISTRY.enabled:
+            metrics.PUBLISH_INFLIGHT.set(len(self._inflight))
+        self._notify(callback, topic, ACKED)
+
+    def _on_publish(self, client, userdata, mid):
+        with self._window:
+            entry = self._inflight.pop(mid, None)
+            if entry is None:
+                # paho may acknowledge before `client.publish` has returned the mid
+                self._acked_early.add(mid)
+                return
+            self._window.notify_all()
+        self._acked(*entry)
+        self._release()
+
+    def _window_open(self):
+        return self.max_inflight is None or len(self._inflight) + self._sending < self.max_inflight
+
+    def _reserve(self):
+        """
+        Reserve a slot in the in-flight window for a new message, False if it has to wait.
+        """
+        with self._window:
+            if len(self._waiting) > 0 or not self._window_open():
+                return False
+            self._sending += 1
+            return True
+
+    def _client_publish(self, topic, payload, retain, callback=None):
+        """
+        Hand a message to the client in a window slot reserved before.
+
+        Returns the `MQTTMessageInfo`; with QoS 0 and `rc != 0` the message is lost.
+        """
+        try:
+            info = self.client.publish(topic, payload, qos=self.qos, retain=retain, properties=self._properties)
+        except Exception:
+            with self._window:
+                self._sending -= 1
+            raise
+        with self._window:
+            self._sending -= 1
+            # QoS 1 / 2 messages are kept by the client and sent after a reconnect
+            if info.rc != 0 and self.qos == 0:
+                self._window.notify_all()
+                return info
+            acked = info.mid in self._acked_early
+            if acked:
+                self._acked_early.discard(info.mid)
+            else:
+                self._inflight[info.mid] = (topic, callback)
+        if acked:
+            self._acked(topic, callback)
+        elif metrics.REGISTRY.enabled:
+            metrics.PUBLISH_INFLIGHT.set(len(self._inflight))
+        return info
+
+    def _hand_over(self, topic, payload, retain, callback):
+        info = self._client_publish(topic, payload, retain, callback)
+        if info.rc != 0 and self.qos == 0:
+            self._failed(topic, callback)
+        else:
+            self._count_published()
+        return info
+
+    def _release(self):
+        """
+        Hand waiting messages to the client while there is room in the window.
+        """
+        while True:
+            with self._window:
+                if len(self._waiting) == 0 or not self._window_open() or not self._is_connected:
+                    return
+                topic, payload, retain, callback = self._waiting.popleft()
+                self._sending += 1
+            self._hand_over(topic, payload, retain, callback)
+
+    def flush(self, timeout=None):
+        """
+        Wait until all messages are handed to the client and acknowledged, returns False on timeout.
+        """
+        with self._window:
+            return self._window.wait_for(lambda: len(self._inflight) == 0 and len(self._waiting) == 0, timeout)
+
+    def _queue_depth(self):
+        return len(getattr(self.client, "_out_packet", ())) + len(getattr(self.client, "_out_messages", ()))
+
+    def _count_published(self):
+        metrics.PUBLISHED.inc()
+        if metrics.REGISTRY.enabled:
+            metrics.PUBLISH_QUEUE.set(self._queue_depth())
+
+    def _send(self, topic, payload, retain):
+        if not self._is_connected or self._queue_depth() >= self.max_queued or not self._reserve():
+            return False
+        if self._client_publish(topic, payload, retain).rc != 0 and self.qos == 0:
+            return False
+        self._count_published()
+        return True
+
+    def _publish(self, topic, payload, retain, callback=None):
+        if self._announced is not None and topic not in self._announced and not topic.startswith("encoding/"):
+            self._announced.add(topic)
+            self._publish("encoding/" + topic, self.encoder.content_type.encode("utf-8"), True)
+        if self.archive is not None:
+            self.archive.put(topic, payload)
+        if self.outbox is not None:
+            # keep the order of messages as long as the outbox is not drained
+            if (self.outbox.pending == 0 and self._is_connected and self._queue_depth() < self.max_queued
+                    and self._reserve()):
+                info = self._client_publish(topic, payload, retain, callback)
+                # the client keeps QoS 1 / 2 messages even if it could not send them yet
+                if info.rc == 0 or self.qos > 0:
+                    self._count_published()
+                    return info
+            self.outbox.put(topic, payload, retain)
+            self._notify(callback, topic, DEFERRED)
+            return None
+        if not self._reserve():
+            with self._window:
+                queued = len(self._waiting) < self.max_queued
+                if queued:
+                    self._waiting.append((topic, payload, retain, callback))
+            if not queued:
+                self._failed(topic, callback)
+            # the window may have opened in between
+            self._release()
+            return None
+        return self._hand_over(topic, payload, retain, callback)
+
+    def _schedule(self, topic, payload, retain, callback=None):
+        if self.scheduler is not None and not self.scheduler.submit(topic, payload, retain):
+            self._notify(callback, topic, DEFERRED)
+            return None
+        return self._publish(topic, payload, retain, callback)
 
     def __enter__(self):
-        self.client.connect("mqtt.eurec4a.eu", 8883, 60)
-        self.client.loop_start()
+        if self.outbox is None:
+            self.client.connect(self.host, self.port, 60)
+            self.client.loop_start()
+            if not self._connected.wait(self.connect_timeout):
+                self.client.loop_stop()
+                raise ConnectionError("no connection to {}:{} after {} s".format(
+                    self.host, self.port, self.connect_timeout))
+        else:
+            # the broker may be unreachable at startup, messages wait in the outbox until it is not
+            self.client.connect_async(self.host, self.port, 60)
+            self.client.loop_start()
+            self._threads.append(threading.Thread(target=self.outbox.drain_forever,
+                                                  args=(self._send, self._connected, self._stop),
+                                                  name="outbox", daemon=True))
+        if self.scheduler is not None:
+            self._threads.append(threading.Thread(target=self.scheduler.run, args=(self._publish, self._stop),
+                                                  name="scheduler", daemon=True))
+        for thread in self._threads:
+            thread.start()
         return self
 
     def __exit__(self, type, value, tb):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        if self.scheduler is not None:
+            # do not lose the newest values on shutdown
+            self.scheduler.flush(self._publish, force=True)
+        if self._is_connected:
+            self.flush(self.flush_timeout)
         self.client.loop_stop()
         self.client.disconnect()
+        if self.outbox is not None:
+            self.outbox.close()
 
-    def publish(self, topic, data, retain=False):
-        if self.deduplicator is not None:
-            if not self.deduplicator.is_new(topic, data):
+    def _log(self, topic, data):
+        if self._log_bucket is not None:
+            if not self._log_bucket.available(1, time.monotonic()):
+                self._log_skipped += 1
                 return
-            self.client.publish(topic, json.dumps(data, default=json_default), retain=retain)
-            print(topic, data)
+            self._log_bucket.take(1)
+        if self._log_skipped > 0:
+            print("({} messages not shown)".format(self._log_skipped))
+            self._log_skipped = 0
+        print(topic, data)
+
+    def publish(self, topic, data, retain=False, callback=None):
+        """
+        Publish `data` encoded by the publisher's encoder, returns the paho `MQTTMessageInfo`.
 
-    def revoke(self, topic, retain=True):
+        Returns None if the message was a duplicate, within the dead-band,
+        deferred by the scheduler, put into the outbox or is waiting for room
+        in the in-flight window. `callback(topic, result)` is called with the
+        result once it is known, for `ACKED` from the client's network thread.
+        """
+        if self.deadband is not None and not self.deadband.is_significant(topic, data):
+            metrics.DEADBAND_SUPPRESSED.inc()
+            self._notify(callback, topic, DROPPED)
+            return None
+        payload = self.encoder.encode(data)
         if self.deduplicator is not None:
-            if not self.deduplicator.is_new(topic, ""):
-                return
-            self.client.publish(topic, "", retain=retain)
+            if not self.deduplicator.is_new(topic, payload):
+                metrics.DEDUP.inc(result="hit")
+                self._notify(callback, topic, DROPPED)
+                return None
+            metrics.DEDUP.inc(result="miss")
+        info = self._schedule(topic, payload, retain, callback)
+        metrics.observe_data_age(topic, data)
+        if self.verbose:
+            self._log(topic, data)
+        return info
+
+    def publish_many(self, messages, retain=False, callback=None):
+        """
+        Publish `(topic, data)` pairs, returns the list of `publish` results.
+        """
+        return [self.publish(topic, data, retain, callback) for topic, data in messages]
+
+    def publish_async(self, topic, data, retain=False):
+        """
+        Publish from a coroutine, returns an `asyncio.Future` with the result (`ACKED`, ...).
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def set_result(result):
+            if not future.done():
+                future.set_result(result)
+
+        self.publish(topic, data, retain, lambda topic, result: loop.call_soon_threadsafe(set_result, result))
+        return future
+
+    async def publish_many_async(self, messages, retain=False):
+        """
+        Publish `(topic, data)` pairs and wait for all results.
+        """
+        import asyncio
+        return await asyncio.gather(*[self.publish_async(topic, data, retain) for topic, data in messages])
+
+    def revoke(self, topic, retain=True, callback=None):
+        if self.deadband is not None:
+            self.deadband.forget(topic)
+        if self.deduplicator is not None:
+            if not self.deduplicator.is_new(topic, b""):
+                metrics.DEDUP.inc(result="hit")
+                self._notify(callback, topic, DROPPED)
+                return None
+            metrics.DEDUP.inc(result="miss")
+        return self._schedule(topic, b"", retain, callback)
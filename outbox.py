@@ -0,0 +1,231 @@
+"""
+Disk-backed outbox for messages which can not be sent to the broker right now.
+
+Messages are appended to a journal file. A small position file next to it
+remembers how far the journal has been sent, so a restart continues where
+the last run stopped (messages may be sent twice, but are not lost).
+
+Retained messages are coalesced per topic: only the newest pending payload
+of a retained topic (e.g. `platform/<id>/location`) is sent, older ones are
+skipped while draining and removed when the journal is compacted. If the
+pending part of the journal grows beyond `max_bytes`, the oldest
+non-retained messages are dropped.
+
+Journal records are `RECORD_HEADER` (flags, topic length, payload length)
+followed by the UTF-8 topic and the payload.
+"""
+import os
+import json
+import time
+import struct
+import threading
+
+import metrics
+
+RECORD_HEADER = struct.Struct("<BHI")
+FLAG_RETAIN = 0x01
+
+
+class Outbox(object):
+    """
+    Append-only journal of pending messages, safe to use from several threads.
+
+    `rate` limits the number of messages per second sent by `drain_forever`,
+    so a reconnect after a long outage does not flood the uplink.
+    """
+    def __init__(self, path, max_bytes=64 * 2**20, rate=50., batch_size=50, fsync=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rate = rate
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.dropped = 0
+        self.pending = 0
+        self._latest = {} # retained topic -> offset of its newest pending record
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a+b")
+        self._size = self._file.seek(0, os.SEEK_END)
+        self.read_pos = min(self._load_position(), self._size)
+        self._scan()
+
+    @property
+    def position_path(self):
+        return self.path + ".pos"
+
+    def _load_position(self):
+        try:
+            with open(self.position_path) as posfile:
+                return json.load(posfile)["position"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return 0
+
+    def _save_position(self):
+        with open(self.position_path + ".tmp", "w") as posfile:
+            json.dump({"position": self.read_pos}, posfile)
+        os.replace(self.position_path + ".tmp", self.position_path)
+
+    def _iter_records(self, start, end):
+        """
+        Yield `(offset, next_offset, flags, topic, payload)` between `start` and `end`.
+        """
+        with open(self.path, "rb") as journal:
+            journal.seek(start)
+            offset = start
+            while offset + RECORD_HEADER.size <= end:
+                flags, topic_length, payload_length = RECORD_HEADER.unpack(journal.read(RECORD_HEADER.size))
+                next_offset = offset + RECORD_HEADER.size + topic_length + payload_length
+                if next_offset > end:
+                    break
+                topic = journal.read(topic_length).decode("utf-8")
+                payload = journal.read(payload_length)
+                yield offset, next_offset, flags, topic, payload
+                offset = next_offset
+
+    def _scan(self):
+        """
+        Rebuild the in-memory index of the pending part of the journal.
+        """
+        end = self.read_pos
+        for offset, end, flags, topic, _ in self._iter_records(self.read_pos, self._size):
+            self.pending += 1
+            if flags & FLAG_RETAIN:
+                if topic in self._latest:
+                    self.pending -= 1
+                self._latest[topic] = offset
+        if end < self._size:
+            # incomplete record from an interrupted write
+            self._file.truncate(end)
+            self._size = end
+        metrics.OUTBOX_PENDING.set(self.pending)
+
+    def put(self, topic, payload, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        topic_bytes = topic.encode("utf-8")
+        record = RECORD_HEADER.pack(FLAG_RETAIN if retain else 0, len(topic_bytes), len(payload)) \
+            + topic_bytes + payload
+        with self.lock:
+            offset = self._size
+            self._file.write(record)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._size += len(record)
+            self.pending += 1
+            if retain:
+                if topic in self._latest:
+                    self.pending -= 1
+                self._latest[topic] = offset
+            if self._size - self.read_pos > self.max_bytes:
+                self._compact()
+            metrics.OUTBOX_PENDING.set(self.pending)
+        self.wakeup.set()
+
+    def _compact(self):
+        """
+        Rewrite the pending part of the journal without superseded retained
+        messages, dropping the oldest other messages if it is still too large.
+        """
+        live = []
+        total = 0
+        for offset, next_offset, flags, topic, _ in self._iter_records(self.read_pos, self._size):
+            if flags & FLAG_RETAIN and self._latest.get(topic) != offset:
+                continue
+            live.append((offset, next_offset - offset, flags & FLAG_RETAIN))
+            total += next_offset - offset
+        dropped = set()
+        for offset, length, retain in live:
+            if total <= self.max_bytes // 2:
+                break
+            if not retain:
+                dropped.add(offset)
+                total -= length
+        keep = {offset for offset, _, _ in live} - dropped
+
+        latest = {}
+        new_offset = 0
+        with open(self.path + ".tmp", "wb") as compacted:
+            for offset, next_offset, flags, topic, payload in self._iter_records(self.read_pos, self._size):
+                if offset not in keep:
+                    continue
+                topic_bytes = topic.encode("utf-8")
+                compacted.write(RECORD_HEADER.pack(flags, len(topic_bytes), len(payload)) + topic_bytes + payload)
+                if flags & FLAG_RETAIN:
+                    latest[topic] = new_offset
+                new_offset += next_offset - offset
+            compacted.flush()
+            os.fsync(compacted.fileno())
+        self._file.close()
+        os.replace(self.path + ".tmp", self.path)
+        self._file = open(self.path, "a+b")
+        self._size = new_offset
+        self.read_pos = 0
+        self._latest = latest
+        self.pending = len(keep)
+        self._save_position()
+        self.dropped += len(dropped)
+        metrics.OUTBOX_DROPPED.inc(len(dropped))
+        if dropped:
+            print("outbox: dropped {} messages".format(len(dropped)))
+
+    def drain(self, send, limit=None):
+        """
+        Send up to `limit` (default `batch_size`) pending messages.
+
+        `send(topic, payload, retain)` returns True if the message was handed
+        to the broker connection. Draining stops at the first failure, the
+        message is then tried again later. Returns the number of messages sent.
+        """
+        if limit is None:
+            limit = self.batch_size
+        sent = 0
+        with self.lock:
+            for offset, next_offset, flags, topic, payload in self._iter_records(self.read_pos, self._size):
+                if sent >= limit:
+                    break
+                retain = bool(flags & FLAG_RETAIN)
+                if not retain or self._latest.get(topic) == offset:
+                    if not send(topic, payload, retain):
+                        break
+                    sent += 1
+                    self.pending -= 1
+                    if retain:
+                        del self._latest[topic]
+                self.read_pos = next_offset
+            if self.read_pos >= self._size:
+                # everything is sent, start over with an empty journal
+                self._file.truncate(0)
+                self._size = 0
+                self.read_pos = 0
+            self._save_position()
+            metrics.OUTBOX_PENDING.set(self.pending)
+        return sent
+
+    def drain_forever(self, send, connected, stop):
+        """
+        Drain at up to `rate` messages per second whenever the `connected` event is set, until `stop` is set.
+        """
+        while not stop.is_set():
+            if self.pending == 0:
+                self.wakeup.wait(1)
+                self.wakeup.clear()
+                continue
+            if not connected.wait(1):
+                continue
+            start = time.monotonic()
+            sent = self.drain(send)
+            if sent == 0:
+                # the connection is busy or just went away
+                stop.wait(0.5)
+                continue
+            stop.wait(max(0., sent / self.rate - (time.monotonic() - start)))
+
+    def close(self):
+        with self.lock:
+            self._file.close()
+
+    def __len__(self):
+        return self.pending
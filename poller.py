@@ -0,0 +1,193 @@
+import asyncio
+import contextvars
+import functools
+import random
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from httpcache import ResponseCache, ParseCache
+from workers import ParsePool
+
+
+class InstrumentedSession(requests.Session):
+    """
+    `requests.Session` which records request durations, response sizes and
+    errors per source if metrics are enabled.
+
+    With a `httpcache.ResponseCache`, GET requests are made conditional on
+    the last response of the same URL.
+    """
+    def __init__(self, cache=None):
+        super(InstrumentedSession, self).__init__()
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        if self.cache is None or not self.cache.cacheable(request, kwargs.get("stream", False)):
+            return super(InstrumentedSession, self).send(request, **kwargs)
+        entry = self.cache.prepare(request)
+        res = super(InstrumentedSession, self).send(request, **kwargs)
+        self.cache.update(request, res, entry)
+        return res
+
+    def request(self, method, url, **kwargs):
+        if not metrics.REGISTRY.enabled:
+            return super(InstrumentedSession, self).request(method, url, **kwargs)
+        source = metrics.current_source.get()
+        start = time.perf_counter()
+        try:
+            res = super(InstrumentedSession, self).request(method, url, **kwargs)
+        except requests.RequestException:
+            metrics.HTTP_ERRORS.inc(source=source)
+            raise
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, source=source)
+        if not kwargs.get("stream", False) and not getattr(res, "from_cache", False):
+            metrics.HTTP_RESPONSE_BYTES.inc(len(res.content), source=source)
+        return res
+
+
+class AsyncHttpClient(object):
+    """
+    Pooled HTTP client which can be shared by many polling coroutines.
+
+    Requests are done via a single `requests.Session` (keep-alive connections
+    are pooled per host) on a thread pool, so blocking I/O does not stall the
+    event loop. `parse` runs parse functions in `parse_workers` processes
+    (see `workers.ParsePool`), or on the thread pool if it is 0.
+
+    With `cache`, GET requests are conditional (`If-None-Match` /
+    `If-Modified-Since`) and parse results are reused for identical content
+    (see `httpcache`).
+    """
+    def __init__(self, max_workers=16, pool_maxsize=16, timeout=20, parse_workers=0, cache=True):
+        self.session = InstrumentedSession(cache=ResponseCache() if cache else None)
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.parse_pool = ParsePool(parse_workers)
+        self.parse_cache = ParseCache() if cache else None
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run a blocking function on the client's thread pool.
+
+        The function runs in a copy of the caller's context, so the metrics
+        of the current source are attributed correctly.
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, context.run, functools.partial(func, *args, **kwargs))
+
+    async def parse(self, func, *args, cache_key=None):
+        """
+        Run `func(*args)` via the parse pool.
+
+        With a `cache_key`, the last result of `func` for that key is returned
+        without parsing if the arguments did not change.
+        """
+        if cache_key is None or self.parse_cache is None:
+            return await self.parse_pool.parse(self, func, *args)
+        key = (func.__module__, func.__qualname__, cache_key)
+        fingerprint = await self.run(ParseCache.fingerprint, args)
+        hit, result = self.parse_cache.get(key, fingerprint)
+        if not hit:
+            result = await self.parse_pool.parse(self, func, *args)
+            self.parse_cache.put(key, fingerprint, result)
+        return result
+
+    async def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return await self.run(self.session.request, method, url, **kwargs)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.parse_pool.close()
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+class PollSource(object):
+    """
+    A single data source which is polled periodically.
+
+    `poll` is a coroutine function which is called with the shared
+    `AsyncHttpClient` and does everything needed for one cycle (fetching,
+    parsing and publishing). A random delay of up to `jitter` seconds is
+    added to the start and to every interval, so that many sources do not
+    fire in lockstep. `close` (if given) is called when polling stops.
+    """
+    def __init__(self, name, poll, interval=30, timeout=20, jitter=0, close=None):
+        self.name = name
+        self.poll = poll
+        self.interval = interval
+        self.timeout = timeout
+        self.jitter = jitter
+        self.close = close
+
+    def __repr__(self):
+        return "PollSource({!r}, interval={}, timeout={}, jitter={})".format(
+            self.name, self.interval, self.timeout, self.jitter)
+
+
+async def poll_forever(source, http):
+    try:
+        await _poll_forever(source, http)
+    finally:
+        if source.close is not None:
+            source.close()
+
+
+async def _poll_forever(source, http):
+    metrics.current_source.set(source.name)
+    if source.jitter > 0:
+        await asyncio.sleep(random.uniform(0, source.jitter))
+    while True:
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(source.poll(http), source.timeout)
+        except asyncio.TimeoutError:
+            print("{}: timed out after {} s".format(source.name, source.timeout))
+            metrics.POLL_ERRORS.inc(source=source.name, kind="timeout")
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            print("{}: poll failed".format(source.name))
+            traceback.print_exc()
+            metrics.POLL_ERRORS.inc(source=source.name, kind="error")
+        elapsed = time.monotonic() - start
+        delay = source.interval - elapsed
+        if source.jitter > 0:
+            delay += random.uniform(0, source.jitter)
+        await asyncio.sleep(max(0, delay))
+
+
+async def poll_all(sources, http=None, parse_workers=0, cache=True):
+    """
+    Poll all sources concurrently, each one at its own interval.
+    """
+    if http is None:
+        with AsyncHttpClient(max_workers=max(4, len(sources)), parse_workers=parse_workers, cache=cache) as http:
+            await asyncio.gather(*[poll_forever(source, http) for source in sources])
+    else:
+        await asyncio.gather(*[poll_forever(source, http) for source in sources])
+
+
+def run(sources, http=None, parse_workers=0, cache=True):
+    asyncio.run(poll_all(sources, http, parse_workers, cache))
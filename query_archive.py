@@ -0,0 +1,43 @@
+"""
+Extract messages for a topic pattern and time range from MQTT archives written by `log.py --archive`.
+
+usage: python query_archive.py ARCHIVE_DIR [-t TOPIC] [--start ISOTIME] [--end ISOTIME]
+"""
+import json
+import datetime
+
+from archive import query, build_index, archive_files
+
+def parse_isotime(s):
+    if s is None:
+        return None
+    t = datetime.datetime.fromisoformat(s)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return t.timestamp()
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description="query MQTT archives")
+    parser.add_argument("paths", nargs="+", help="archive files or directories")
+    parser.add_argument("-t", "--topic", default="#", help="MQTT topic pattern (+ and # wildcards)")
+    parser.add_argument("--start", default=None, help="start time (ISO, UTC)")
+    parser.add_argument("--end", default=None, help="end time (ISO, UTC)")
+    parser.add_argument("--json", action="store_true", help="print JSON lines instead of text")
+    parser.add_argument("--reindex", action="store_true", help="rebuild the indices of the given files / directories first")
+    args = parser.parse_args()
+
+    if args.reindex:
+        for path in archive_files(args.paths):
+            build_index(path)
+
+    for t, topic, payload in query(args.paths, args.topic, parse_isotime(args.start), parse_isotime(args.end)):
+        time = datetime.datetime.utcfromtimestamp(t).isoformat()
+        payload = payload.decode("utf-8", "replace")
+        if args.json:
+            print(json.dumps({"time": time, "topic": topic, "payload": payload}))
+        else:
+            print(time, topic, payload)
+
+if __name__ == "__main__":
+    _main()
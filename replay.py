@@ -0,0 +1,203 @@
+"""
+Replay recorded MQTT messages through `EUREC4AMqttPublisher` as a load test.
+
+Reads archives written by `log.py --archive` (or text logs written by
+`log.py`) and republishes them at a configurable speed-up factor, then reports
+the achieved throughput and latency percentiles. The broker is taken from
+`mqtt_import.json` unless `--host` / `--port` are given, e.g. to run against
+a local `fakebroker.py`.
+
+usage: python replay.py ARCHIVE... [--speed 10] [--host 127.0.0.1 --port 1883 --no-tls]
+"""
+import ast
+import json
+import time
+import datetime
+import threading
+
+import numpy as np
+
+from mqtt_utils import EUREC4AMqttPublisher, ACKED, DEFERRED, DROPPED, FAILED
+from archive import query, topic_matches
+from benchtools import Subscriber
+
+
+def read_text_log(path):
+    """
+    Yield `(time, topic, payload)` from a text log written by `log.py`.
+    """
+    with open(path) as logfile:
+        for line in logfile:
+            t, topic, payload = line.rstrip("\n").split(" ", 2)
+            t = datetime.datetime.fromisoformat(t).replace(tzinfo=datetime.timezone.utc).timestamp()
+            yield t, topic, ast.literal_eval(payload)
+
+
+def read_messages(paths, topic="#"):
+    for path in paths:
+        if path.endswith(".mqa") or not path.endswith((".txt", ".log")):
+            yield from query(path, topic)
+        else:
+            for t, t_topic, payload in read_text_log(path):
+                if topic_matches(topic, t_topic):
+                    yield t, t_topic, payload
+
+
+def percentiles(values, qs=(50, 90, 99, 100)):
+    if len(values) == 0:
+        return {}
+    values = np.asarray(values) * 1000.
+    return {"p{}_ms".format(q): float(np.percentile(values, q)) for q in qs}
+
+
+class LatencyProbe(Subscriber):
+    """
+    Subscribes to the replayed topics and measures the time from publishing to delivery.
+
+    MQTT keeps the order of messages per topic, so the send times are matched
+    per topic in FIFO order.
+    """
+    def __init__(self, host, port, tls, topic):
+        self.sent = {}
+        self.latencies = []
+        super().__init__(port, topic, host=host, tls=tls)
+
+    def sending(self, topic, t):
+        with self.lock:
+            self.sent.setdefault(topic, []).append(t)
+
+    def cancel(self, topic, t):
+        with self.lock:
+            pending = self.sent.get(topic)
+            if pending and t in pending:
+                pending.remove(t)
+
+    def pending(self):
+        with self.lock:
+            return any(self.sent.values())
+
+    def received(self, msg, now):
+        if msg.retain:
+            return
+        pending = self.sent.get(msg.topic)
+        if pending:
+            self.latencies.append(now - pending.pop(0))
+
+
+def replay(messages, publisher, speed=1., prefix="", probe=None):
+    """
+    Republish `(time, topic, payload)` tuples, `speed` of 0 means as fast as possible.
+
+    Returns a dict with counters, throughput and publish latencies (time from
+    handing the message to the publisher until it was acknowledged). At most
+    `publisher.max_queued` messages are outstanding at a time, so a replay
+    faster than the broker waits instead of overflowing the publisher.
+    """
+    results = {ACKED: 0, DEFERRED: 0, DROPPED: 0, FAILED: 0}
+    ack_latencies = []
+    outstanding = [0]
+    done = threading.Condition()
+
+    def result_callback(t):
+        def on_result(topic, result):
+            now = time.perf_counter()
+            if probe is not None and result in (DROPPED, FAILED):
+                probe.cancel(topic, t)
+            with done:
+                results[result] += 1
+                if result == ACKED:
+                    ack_latencies.append(now - t)
+                outstanding[0] -= 1
+                done.notify_all()
+        return on_result
+
+    skipped = 0
+    lateness = []
+    first_record = None
+    start = time.perf_counter()
+    for t, topic, payload in messages:
+        if first_record is None:
+            first_record = t
+        if speed > 0:
+            due = start + (t - first_record) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                lateness.append(-delay)
+        if len(payload) > 0:
+            try:
+                data = json.loads(payload)
+            except ValueError:
+                skipped += 1
+                continue
+        with done:
+            done.wait_for(lambda: outstanding[0] < publisher.max_queued)
+            outstanding[0] += 1
+        topic = prefix + topic
+        now = time.perf_counter()
+        if probe is not None:
+            probe.sending(topic, now)
+        if len(payload) == 0:
+            publisher.revoke(topic, callback=result_callback(now))
+        else:
+            publisher.publish(topic, data, callback=result_callback(now))
+    duration = time.perf_counter() - start
+
+    # give outstanding messages a moment to be acknowledged and delivered
+    with done:
+        done.wait_for(lambda: outstanding[0] == 0, 5)
+    deadline = time.perf_counter() + 5
+    while time.perf_counter() < deadline and probe is not None and probe.pending():
+        time.sleep(0.05)
+
+    published = results[ACKED] + results[DEFERRED]
+    report = {
+        "published": published,
+        "acked": results[ACKED],
+        "deferred": results[DEFERRED], # held back by the scheduler or put into the outbox
+        "dropped": results[DROPPED], # duplicates and within the dead-band
+        "failed": results[FAILED],
+        "skipped": skipped, # non-JSON payloads
+        "duration_s": duration,
+        "messages_per_s": published / duration if duration > 0 else float("nan"),
+        "speed": speed,
+        "publish_latency": percentiles(ack_latencies),
+        "schedule_lateness": percentiles(lateness),
+    }
+    if probe is not None:
+        report["delivered"] = len(probe.latencies)
+        report["delivery_latency"] = percentiles(probe.latencies)
+    return report
+
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description="replay MQTT archives against a broker")
+    parser.add_argument("paths", nargs="+", help="archive files / directories or text logs")
+    parser.add_argument("-t", "--topic", default="#", help="only replay topics matching this pattern")
+    parser.add_argument("--speed", type=float, default=1., help="speed-up factor, 0 for as fast as possible")
+    parser.add_argument("--prefix", default="replay/", help="prefix for replayed topics")
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--no-tls", dest="tls", action="store_false", default=None)
+    parser.add_argument("--deduplicate", action="store_true", help="pass messages through the deduplicator")
+    parser.add_argument("--no-probe", dest="probe", action="store_false",
+                        help="do not measure delivery latency with a second client")
+    args = parser.parse_args()
+
+    with EUREC4AMqttPublisher(deduplicate=args.deduplicate, host=args.host, port=args.port, tls=args.tls,
+                              verbose=False) as publisher:
+        probe = None
+        if args.probe:
+            probe = LatencyProbe(publisher.host, publisher.port, args.tls, args.prefix + args.topic)
+        try:
+            report = replay(read_messages(args.paths, args.topic), publisher,
+                            speed=args.speed, prefix=args.prefix, probe=probe)
+        finally:
+            if probe is not None:
+                probe.close()
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    _main()
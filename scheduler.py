@@ -0,0 +1,146 @@
+"""
+Rate limits for outgoing messages, to cap the uplink use of a deployment.
+
+A `PublishScheduler` combines
+
+- `min_intervals`: minimum seconds between two messages of one topic, keyed
+  by MQTT topic patterns (`platform/+/location`, `platform/#`, ...),
+- `rate_limits`: token buckets keyed by topic prefix, as messages per second
+  or `[messages_per_second, burst]`, the longest matching prefix is used,
+- `bytes_per_second`: a global budget for topic and payload bytes, with a
+  burst of `burst_seconds` worth of bytes.
+
+Messages which may not be sent right away wait in a pending map which keeps
+only the newest message per topic, so a tight budget sends the latest value
+of every topic instead of a growing backlog. The limits can be set without
+touching the importers in `mqtt_import.json`, e.g.:
+
+    "schedule": {
+        "min_intervals": {"platform/+/location": 60},
+        "rate_limits": {"platform/": [1, 20]},
+        "bytes_per_second": 500
+    }
+"""
+import time
+import threading
+from collections import OrderedDict
+
+import metrics
+from archive import topic_matches
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def available(self, amount, now):
+        self._refill(now)
+        # amounts larger than the bucket pass once it is full
+        return self.tokens >= min(amount, self.capacity)
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class PublishScheduler(object):
+    def __init__(self, min_intervals=None, rate_limits=None, bytes_per_second=None, burst_seconds=10,
+                 tick=0.1):
+        self.min_intervals = dict(min_intervals or {})
+        self.buckets = {}
+        for prefix, limit in (rate_limits or {}).items():
+            rate, burst = limit if isinstance(limit, (list, tuple)) else (limit, max(1., limit))
+            self.buckets[prefix] = TokenBucket(rate, burst)
+        if bytes_per_second is not None:
+            self.byte_bucket = TokenBucket(bytes_per_second, bytes_per_second * burst_seconds)
+        else:
+            self.byte_bucket = None
+        self.tick = tick
+        self.pending = OrderedDict() # topic -> (payload, retain)
+        self.last_sent = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self._topic_limits = {}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**config)
+
+    def _limits(self, topic):
+        """
+        Minimum interval and token bucket of `topic`, cached per topic.
+        """
+        limits = self._topic_limits.get(topic)
+        if limits is None:
+            min_interval = max([interval for pattern, interval in self.min_intervals.items()
+                                if topic_matches(pattern, topic)], default=0)
+            prefixes = [prefix for prefix in self.buckets if topic.startswith(prefix)]
+            bucket = self.buckets[max(prefixes, key=len)] if prefixes else None
+            limits = self._topic_limits[topic] = (min_interval, bucket)
+        return limits
+
+    def _try_take(self, topic, size, now):
+        min_interval, bucket = self._limits(topic)
+        if min_interval > 0 and now - self.last_sent.get(topic, -float("inf")) < min_interval:
+            return False
+        if bucket is not None and not bucket.available(1, now):
+            return False
+        if self.byte_bucket is not None and not self.byte_bucket.available(size, now):
+            return False
+        if bucket is not None:
+            bucket.take(1)
+        if self.byte_bucket is not None:
+            self.byte_bucket.take(size)
+        self.last_sent[topic] = now
+        return True
+
+    def submit(self, topic, payload, retain=False):
+        """
+        Returns True if the message may be sent now, otherwise it replaces any pending message of the topic.
+        """
+        with self.lock:
+            if topic not in self.pending and self._try_take(topic, len(topic) + len(payload), time.monotonic()):
+                return True
+            if topic in self.pending:
+                metrics.SCHEDULER_SUPERSEDED.inc()
+            else:
+                metrics.SCHEDULER_DEFERRED.inc()
+            self.pending[topic] = (payload, retain)
+        self.wakeup.set()
+        return False
+
+    def flush(self, send, force=False):
+        """
+        Send all pending messages which are within the limits (or all, if `force`) via `send(topic, payload, retain)`.
+        """
+        ready = []
+        with self.lock:
+            now = time.monotonic()
+            for topic, (payload, retain) in list(self.pending.items()):
+                if force or self._try_take(topic, len(topic) + len(payload), now):
+                    del self.pending[topic]
+                    ready.append((topic, payload, retain))
+        for topic, payload, retain in ready:
+            send(topic, payload, retain)
+        return len(ready)
+
+    def run(self, send, stop):
+        """
+        Flush pending messages every `tick` seconds until `stop` is set.
+        """
+        while not stop.is_set():
+            if len(self.pending) == 0:
+                self.wakeup.wait(1)
+                self.wakeup.clear()
+                continue
+            self.flush(send)
+            stop.wait(self.tick)
+
+    def __len__(self):
+        return len(self.pending)
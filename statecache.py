@@ -0,0 +1,245 @@
+"""
+Live cache of the latest platform messages with a small HTTP/JSON API.
+
+Subscribes to `platform/+/+` on the broker (retained messages fill the
+cache right away) and keeps the latest decoded value of every
+`platform/<id>/<kind>` topic. Positions from `location` messages are kept in
+a grid of `cell_size` degrees, so bounding box queries only look at the
+platforms in the overlapping cells. API:
+
+- `/platforms`: all platforms with all their values
+- `/platforms/<id>`: the values of one platform
+- `/bbox?south=..&west=..&north=..&east=..`: platforms in a bounding box
+  (`west > east` crosses the date line)
+- `/stale?max_age=600`: platforms without new data for `max_age` seconds,
+  by the `time` in their messages if there is one
+
+usage: python statecache.py [--port 8081] [--host 127.0.0.1 --mqtt-port 1883 --no-tls]
+"""
+import json
+import math
+import time
+import threading
+import http.server
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from mqtt_utils import get_mqtt_client, get_mqtt_config, json_default
+
+
+def message_time(data):
+    """
+    Unix time of the `time` field of a decoded message, None if there is none.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("time"), str):
+        return None
+    try:
+        t = np.datetime64(data["time"].rstrip("Z").replace("+00:00", ""), "us")
+    except ValueError:
+        return None
+    return (t - np.datetime64(0, "us")) / np.timedelta64(1, "s")
+
+
+class PlatformCache(object):
+    def __init__(self, cell_size=1.):
+        self.cell_size = cell_size
+        self.platforms = {} # platform -> {kind: value}
+        self.updated = {} # platform -> Unix time of the newest data
+        self.positions = {} # platform -> (lat, lon)
+        self.grid = {} # (i, j) -> set of platforms
+        self.lock = threading.Lock()
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size))
+
+    def _move(self, platform, position):
+        old = self.positions.pop(platform, None)
+        if old is not None:
+            cell = self.grid[self._cell(*old)]
+            cell.discard(platform)
+            if len(cell) == 0:
+                del self.grid[self._cell(*old)]
+        if position is not None:
+            self.positions[platform] = position
+            self.grid.setdefault(self._cell(*position), set()).add(platform)
+
+    def update(self, topic, data, received=None):
+        """
+        Store the decoded message `data` of `platform/<id>/<kind>`, None removes the value.
+        """
+        parts = topic.split("/")
+        if len(parts) != 3 or parts[0] != "platform":
+            return
+        _, platform, kind = parts
+        if received is None:
+            received = time.time()
+        with self.lock:
+            values = self.platforms.setdefault(platform, {})
+            if data is None:
+                values.pop(kind, None)
+                if kind == "location":
+                    self._move(platform, None)
+                if len(values) == 0:
+                    del self.platforms[platform]
+                    self.updated.pop(platform, None)
+                return
+            values[kind] = data
+            t = message_time(data)
+            self.updated[platform] = max(self.updated.get(platform, 0), t if t is not None else received)
+            if kind == "location":
+                try:
+                    position = (float(data["lat"]), float(data["lon"]))
+                except (KeyError, TypeError, ValueError):
+                    position = None
+                if position is not None and not all(map(math.isfinite, position)):
+                    position = None
+                self._move(platform, position)
+
+    def get(self, platform):
+        with self.lock:
+            values = self.platforms.get(platform)
+            return None if values is None else dict(values)
+
+    def all(self):
+        with self.lock:
+            return {platform: dict(values) for platform, values in self.platforms.items()}
+
+    def bbox(self, south, west, north, east):
+        """
+        Platforms with a position inside the box, as `{platform: location}`.
+        """
+        if west > east:
+            result = self.bbox(south, west, north, 180.)
+            result.update(self.bbox(south, -180., north, east))
+            return result
+        i0, j0 = self._cell(south, west)
+        i1, j1 = self._cell(north, east)
+        result = {}
+        with self.lock:
+            if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self.grid):
+                cells = [cell for (i, j), cell in self.grid.items() if i0 <= i <= i1 and j0 <= j <= j1]
+            else:
+                cells = [self.grid[(i, j)] for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)
+                         if (i, j) in self.grid]
+            for cell in cells:
+                for platform in cell:
+                    lat, lon = self.positions[platform]
+                    if south <= lat <= north and west <= lon <= east:
+                        result[platform] = self.platforms[platform]["location"]
+        return result
+
+    def stale(self, max_age, now=None):
+        """
+        Platforms without new data for `max_age` seconds, as `{platform: age in seconds}`.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return {platform: now - t for platform, t in self.updated.items() if now - t > max_age}
+
+
+class StateCacheHandler(http.server.BaseHTTPRequestHandler):
+    cache = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, default=json_default).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        parts = [p for p in url.path.split("/") if p]
+        try:
+            if parts == ["platforms"]:
+                self._send_json(self.cache.all())
+            elif len(parts) == 2 and parts[0] == "platforms":
+                values = self.cache.get(parts[1])
+                if values is None:
+                    self._send_json({"error": "unknown platform"}, 404)
+                else:
+                    self._send_json(values)
+            elif parts == ["bbox"]:
+                self._send_json(self.cache.bbox(float(query["south"]), float(query["west"]),
+                                                float(query["north"]), float(query["east"])))
+            elif parts == ["stale"]:
+                self._send_json(self.cache.stale(float(query.get("max_age", 600))))
+            else:
+                self._send_json({"error": "not found"}, 404)
+        except (KeyError, ValueError) as e:
+            self._send_json({"error": "bad query: {}".format(e)}, 400)
+
+
+def serve(cache, port, host="127.0.0.1"):
+    """
+    Serve the API of `cache` from a background thread.
+    """
+    handler = type("Handler", (StateCacheHandler,), {"cache": cache})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="statecache", daemon=True).start()
+    return server
+
+
+def subscribe(cache, host=None, port=None, tls=None, decode=json.loads):
+    """
+    Feed `cache` from the broker, returns the running paho client.
+    """
+    config = get_mqtt_config()
+    client = get_mqtt_client(tls=tls)
+
+    def on_connect(client, userdata, flags, rc, properties=None):
+        client.subscribe("platform/+/+")
+
+    def on_message(client, userdata, msg):
+        if len(msg.payload) == 0:
+            cache.update(msg.topic, None)
+            return
+        try:
+            data = decode(msg.payload)
+        except ValueError:
+            return
+        cache.update(msg.topic, data)
+
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(host if host is not None else config["host"], port if port is not None else config["port"], 60)
+    client.loop_start()
+    return client
+
+
+def _main():
+    import argparse
+    from encoders import get_encoder
+    parser = argparse.ArgumentParser(description="cache the latest platform messages and serve them over HTTP")
+    parser.add_argument("--port", type=int, default=8081, help="HTTP port")
+    parser.add_argument("--bind", default="127.0.0.1", help="HTTP address")
+    parser.add_argument("--cell-size", type=float, default=1., help="grid cell size in degrees")
+    parser.add_argument("--encoding", default="json", help="payload encoding, see encoders.py")
+    parser.add_argument("--host", default=None, help="MQTT broker")
+    parser.add_argument("--mqtt-port", type=int, default=None)
+    parser.add_argument("--no-tls", dest="tls", action="store_false", default=None)
+    args = parser.parse_args()
+
+    cache = PlatformCache(cell_size=args.cell_size)
+    client = subscribe(cache, args.host, args.mqtt_port, args.tls, get_encoder(args.encoding).decode)
+    server = serve(cache, args.port, args.bind)
+    print("serving on http://{}:{}/platforms".format(*server.server_address))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.loop_stop()
+        client.disconnect()
+
+if __name__ == "__main__":
+    _main()
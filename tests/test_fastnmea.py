@@ -0,0 +1,24 @@
+import datetime
+
+from benchtools import nmea_sentence as sentence
+from fastnmea import FastNMEADecoder
+from get_noaa_ship import NMEAAssetState
+
+
+def test_fallback_sentence_is_decoded_every_time():
+    decoder = FastNMEADecoder()
+    state = NMEAAssetState()
+    assert decoder.decode_line(state, sentence("GPGST,120000.00,1.2,0.5,0.3,45.0,0.4,0.3,0.8"))
+    assert state.time_of_day.replace(tzinfo=None) == datetime.time(12, 0, 0)
+    assert decoder.decode_line(state, sentence("GPGST,120001.00,1.2,0.5,0.3,45.0,0.4,0.3,0.8"))
+    assert state.time_of_day.replace(tzinfo=None) == datetime.time(12, 0, 1)
+    assert "GST" not in decoder._irrelevant
+
+
+def test_irrelevant_sentence_is_skipped():
+    decoder = FastNMEADecoder()
+    state = NMEAAssetState()
+    line = sentence("GPGSA,A,3,04,05,,09,12,,,24,,,,,2.5,1.3,2.1")
+    assert not decoder.decode_line(state, line)
+    assert not decoder.decode_line(state, line)
+    assert state.time_of_day is None
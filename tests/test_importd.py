@@ -0,0 +1,20 @@
+import sys
+import types
+
+import importd
+import poller
+
+
+def test_failing_plugin_does_not_stop_the_others(monkeypatch):
+    def broken(publisher):
+        raise FileNotFoundError("liquidr_gliders.json")
+
+    def working(publisher):
+        async def poll(http):
+            pass
+        return [poller.PollSource("a", poll, interval=60)]
+
+    monkeypatch.setitem(sys.modules, "plugin_broken", types.SimpleNamespace(get_sources=broken))
+    monkeypatch.setitem(sys.modules, "plugin_working", types.SimpleNamespace(get_sources=working))
+    sources = importd.load_sources(None, [{"module": "plugin_broken"}, {"module": "plugin_working"}])
+    assert [source.name for source in sources] == ["plugin_working:a"]
@@ -0,0 +1,39 @@
+import asyncio
+
+import get_noaa_ship
+from benchtools import nmea_sentence
+
+
+class Tail(object):
+    feed = []
+
+    def __init__(self, url, **kwargs):
+        pass
+
+    def poll(self):
+        return self.feed.pop(0)
+
+    def commit(self):
+        pass
+
+
+class Http(object):
+    session = None
+
+    async def run(self, func, *args):
+        return func(*args)
+
+    async def parse(self, func, *args):
+        return func(*args)
+
+
+def test_idle_feed_backs_off(monkeypatch):
+    monkeypatch.setattr(get_noaa_ship, "HttpTail", Tail)
+    line = nmea_sentence("HEHDT,93.5,T").encode("ascii")
+    Tail.feed = [[], [], [], [], [], [line], []]
+    source, = get_noaa_ship.get_sources(None, assets=["33RO"], interval=5, statefile=None, max_interval=30)
+    intervals = []
+    for _ in range(len(Tail.feed)):
+        asyncio.run(source.poll(Http()))
+        intervals.append(source.interval)
+    assert intervals == [10, 20, 30, 30, 30, 5, 10]
@@ -0,0 +1,49 @@
+from outbox import Outbox, RECORD_HEADER
+
+
+def drain_all(outbox):
+    messages = []
+
+    def send(topic, payload, retain):
+        messages.append((topic, payload, retain))
+        return True
+
+    while outbox.drain(send) > 0:
+        pass
+    return messages
+
+
+def test_compacted_journal_survives_a_restart(tmp_path):
+    path = str(tmp_path / "outbox.journal")
+    outbox = Outbox(path, max_bytes=4000)
+    for i in range(200):
+        outbox.put("platform/{}/location".format(i % 3), b'{"i": %d}' % i, retain=True)
+        outbox.put("status/{}".format(i), b'{"i": %d}' % i)
+    assert outbox.dropped > 0
+    assert outbox._size <= outbox.max_bytes
+
+    sent = []
+    outbox.drain(lambda topic, payload, retain: sent.append(topic) or True, limit=5)
+    assert len(sent) == 5
+    outbox.close()
+
+    # a record cut short by a crash is discarded on the next start
+    with open(path, "ab") as journal:
+        journal.write(RECORD_HEADER.pack(0, 10, 100) + b"status")
+
+    outbox = Outbox(path, max_bytes=4000)
+    messages = drain_all(outbox)
+    outbox.close()
+
+    retained = [(topic, payload) for topic, payload, retain in messages if retain]
+    assert sorted(retained) == [("platform/0/location", b'{"i": 198}'),
+                                ("platform/1/location", b'{"i": 199}'),
+                                ("platform/2/location", b'{"i": 197}')]
+    others = [topic for topic, payload, retain in messages if not retain]
+    # the newest messages are kept in order, nothing is sent twice
+    assert others == ["status/{}".format(i) for i in range(200 - len(others), 200)]
+    assert not set(others) & set(sent)
+
+    outbox = Outbox(path)
+    assert len(outbox) == 0
+    outbox.close()
@@ -0,0 +1,58 @@
+import time
+import asyncio
+
+import fakebroker
+from mqtt_utils import EUREC4AMqttPublisher, ACKED, FAILED
+
+
+def make_publisher(port, **kwargs):
+    return EUREC4AMqttPublisher(host="127.0.0.1", port=port, tls=False, verbose=False, deduplicate=False,
+                                **kwargs)
+
+
+def test_full_window_does_not_block_the_loop():
+    broker, port = fakebroker.start_in_thread()
+    with make_publisher(port, qos=1, max_inflight=5) as publisher:
+        broker.hold_acks = True
+
+        async def main():
+            start = time.monotonic()
+            futures = [publisher.publish_async("test/{}".format(i), {"i": i}) for i in range(20)]
+            assert time.monotonic() - start < 0.5
+
+            ticks = 0
+            while time.monotonic() - start < 0.5:
+                await asyncio.sleep(0.01)
+                ticks += 1
+            assert ticks > 20
+            assert not any(future.done() for future in futures)
+            assert broker.messages_in == 5
+            assert len(publisher._inflight) == 5
+            assert len(publisher._waiting) == 15
+
+            broker.release_acks()
+            return await asyncio.wait_for(asyncio.gather(*futures), 10)
+
+        assert asyncio.run(main()) == [ACKED] * 20
+        assert broker.messages_in == 20
+
+
+def test_late_acks_are_forgotten_on_disconnect():
+    publisher = make_publisher(1883, qos=0)
+    publisher._on_publish(publisher.client, None, 42)
+    assert publisher._acked_early == {42}
+    publisher._on_disconnect(publisher.client, None, 1)
+    assert publisher._acked_early == set()
+
+
+def test_failed_messages_are_not_deduplicated():
+    broker, port = fakebroker.start_in_thread()
+    results = []
+    with EUREC4AMqttPublisher(host="127.0.0.1", port=port, tls=False, verbose=False, qos=1,
+                              max_inflight=1, max_queued=0) as publisher:
+        broker.hold_acks = True
+        publisher.publish("test/a", {"i": 0})
+        publisher.publish("test/b", {"i": 1}, callback=lambda topic, result: results.append(result))
+        publisher.publish("test/b", {"i": 1}, callback=lambda topic, result: results.append(result))
+        broker.release_acks()
+    assert results == [FAILED, FAILED]
@@ -0,0 +1,17 @@
+import json
+
+import fakebroker
+import replay
+from mqtt_utils import EUREC4AMqttPublisher
+
+
+def test_replay_waits_for_the_window():
+    broker, port = fakebroker.start_in_thread()
+    messages = [(1000 + i, "platform/b{}/location".format(i % 7), json.dumps({"i": i}).encode("utf-8"))
+                for i in range(300)]
+    with EUREC4AMqttPublisher(host="127.0.0.1", port=port, tls=False, verbose=False, deduplicate=False,
+                              qos=1, max_inflight=10, max_queued=20) as publisher:
+        report = replay.replay(messages, publisher, speed=0)
+    assert report["published"] == report["acked"] == 300
+    assert report["failed"] == report["skipped"] == 0
+    assert broker.messages_in == 300
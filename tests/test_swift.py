@@ -0,0 +1,60 @@
+import json
+import types
+import asyncio
+import datetime
+
+import numpy as np
+
+import get_swift
+from mqtt_utils import ACKED, FAILED
+
+
+class Http(object):
+    session = None
+
+    def __init__(self, records):
+        self.records = records
+
+    async def run(self, func, *args, **kwargs):
+        content = json.dumps({"success": True, "buoys": [{"name": "SWIFT 1", "data": self.records}]})
+        return types.SimpleNamespace(content=content.encode("utf-8"))
+
+    async def parse(self, func, *args, cache_key=None):
+        return func(*args)
+
+
+class Publisher(object):
+    def __init__(self, result):
+        self.result = result
+
+    def publish(self, topic, data, retain=False, callback=None):
+        if callback is not None:
+            callback(topic, self.result)
+
+
+def poll(result):
+    cursor = get_swift.SwiftCursor(statefile=None)
+    source, = get_swift.get_sources(Publisher(result), cursor=cursor, buoys=["SWIFT 1"])
+    http = Http([{"timestamp": "2020-01-20T12:00:00Z", "lat": 13.1, "lon": -57.3}])
+    asyncio.run(source.poll(http))
+    return cursor.get("SWIFT 1")
+
+
+def test_cursor_only_advances_if_the_record_was_not_lost():
+    assert poll(ACKED) == datetime.datetime(2020, 1, 20, 12)
+    assert poll(FAILED) is None
+
+
+def test_parse_timestamp_column_converts_offsets():
+    times = get_swift.parse_timestamp_column(["2020-01-20T12:00:00Z", "2020-01-20T12:00:00.5+00:00",
+                                              "2020-01-20T12:00:00-05:00"])
+    assert list(times) == [np.datetime64("2020-01-20T12:00:00"), np.datetime64("2020-01-20T12:00:00.5"),
+                           np.datetime64("2020-01-20T17:00:00")]
+
+
+def test_latest_record_skips_nat():
+    columns = {"time": np.array(["2020-01-20T12:00", "NaT", "2020-01-20T11:00"], dtype="datetime64[us]"),
+               "lat": np.array([13.1, 13.2, np.nan])}
+    assert get_swift.latest_record(columns) == {"time": datetime.datetime(2020, 1, 20, 12), "lat": 13.1}
+    columns = {"time": np.array(["NaT"], dtype="datetime64[us]"), "lat": np.array([13.1])}
+    assert get_swift.latest_record(columns) is None
@@ -0,0 +1,23 @@
+import numpy as np
+
+from track import TrackPublisher
+
+
+class RecordingPublisher(object):
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, topic, data, retain=False):
+        self.messages.append((topic, len(data["t"])))
+
+
+def test_batch_larger_than_buffer_publishes_full_track():
+    publisher = RecordingPublisher()
+    tracker = TrackPublisher(publisher, "X", full_interval=600, max_points=10)
+    t0 = np.datetime64("2020-01-20T00:00:00")
+    tracker.update([t0], [13.], [-57.])
+    times = t0 + np.arange(1, 16) * np.timedelta64(30, "s")
+    tracker.update(times, np.full(15, 13.), np.full(15, -57.))
+    tracker.update([times[-1] + np.timedelta64(30, "s")], [13.], [-57.])
+    assert publisher.messages == [("platform/X/track", 1), ("platform/X/track", 10),
+                                  ("platform/X/track/append", 1)]
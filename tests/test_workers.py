@@ -0,0 +1,43 @@
+import os
+import signal
+import asyncio
+
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+
+from workers import ParsePool
+
+
+class Http(object):
+    async def run(self, func, *args):
+        return func(*args)
+
+
+def test_killed_worker_is_replaced():
+    pool = ParsePool(processes=1)
+
+    async def main():
+        assert await pool.parse(Http(), len, b"abc") == 3
+        for pid in list(pool._executor._processes):
+            os.kill(pid, signal.SIGKILL)
+        await asyncio.sleep(0.5)
+        return await pool.parse(Http(), len, b"abcd")
+
+    try:
+        assert asyncio.run(main()) == 4
+    finally:
+        pool.close()
+
+
+def test_crashing_parse_does_not_break_later_parses():
+    pool = ParsePool(processes=1)
+
+    async def main():
+        with pytest.raises(BrokenProcessPool):
+            await pool.parse(Http(), os._exit, 1)
+        return await pool.parse(Http(), len, b"abc")
+
+    try:
+        assert asyncio.run(main()) == 3
+    finally:
+        pool.close()
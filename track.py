@@ -0,0 +1,120 @@
+"""
+Track history of a platform as compact columnar messages.
+
+`TrackPublisher` keeps the recent track of a platform in a `TrackBuffer` and
+publishes
+
+- `platform/<id>/track` (retained): the whole buffered track, at most every
+  `full_interval` seconds,
+- `platform/<id>/track/append`: only the new points in between.
+
+Both carry the same self-contained format, so clients decode the retained
+track and concatenate the appended points:
+
+    {
+        "time": "2020-01-20T12:00:30",  # time of the last point
+        "scale": 100000,                # lat / lon are integers in 1/scale degrees
+        "t": [1579521600, 30, 30],      # Unix time of the first point, then deltas in s
+        "lat": [1310000, 12, -3],       # first value, then deltas
+        "lon": [-5730000, 30, 28]
+    }
+"""
+import time
+
+import numpy as np
+
+
+def delta_encode(values):
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) == 0:
+        return []
+    return np.concatenate([values[:1], np.diff(values)]).tolist()
+
+
+def delta_decode(values):
+    return np.cumsum(np.asarray(values, dtype=np.int64))
+
+
+def decode_track(payload):
+    """
+    Convert a track message into `(time, lat, lon)` arrays.
+    """
+    t = delta_decode(payload["t"]).astype("datetime64[s]")
+    return t, delta_decode(payload["lat"]) / payload["scale"], delta_decode(payload["lon"]) / payload["scale"]
+
+
+class TrackBuffer(object):
+    """
+    The last `max_points` points of a track, no older than `max_age` seconds before the newest one.
+    """
+    def __init__(self, max_points=2880, max_age=86400, scale=100000):
+        self.max_points = max_points
+        self.max_age = max_age
+        self.scale = scale
+        self.t = np.zeros(0, dtype=np.int64)
+        self.lat = np.zeros(0, dtype=np.int64)
+        self.lon = np.zeros(0, dtype=np.int64)
+
+    def extend(self, times, lats, lons):
+        """
+        Append the points newer than the last buffered one, returns the number of appended points.
+        """
+        t = np.asarray(times, dtype="datetime64[s]").astype(np.int64)
+        lat = np.asarray(lats, dtype=float)
+        lon = np.asarray(lons, dtype=float)
+        valid = np.isfinite(lat) & np.isfinite(lon) & (t != np.datetime64("NaT").astype(np.int64))
+        if len(self.t) > 0:
+            valid &= t > self.t[-1]
+        if not np.any(valid):
+            return 0
+        order = np.argsort(t[valid], kind="stable")
+        t = t[valid][order]
+        lat = np.round(lat[valid][order] * self.scale).astype(np.int64)
+        lon = np.round(lon[valid][order] * self.scale).astype(np.int64)
+        # drop repeated timestamps of the new points
+        unique = np.concatenate([[True], np.diff(t) > 0])
+        self.t = np.concatenate([self.t, t[unique]])
+        self.lat = np.concatenate([self.lat, lat[unique]])
+        self.lon = np.concatenate([self.lon, lon[unique]])
+        keep = max(len(self.t) - self.max_points, np.searchsorted(self.t, self.t[-1] - self.max_age))
+        if keep > 0:
+            self.t = self.t[keep:]
+            self.lat = self.lat[keep:]
+            self.lon = self.lon[keep:]
+        return int(np.count_nonzero(unique))
+
+    def payload(self, start=0):
+        """
+        Message with the buffered points from index `start` on.
+        """
+        return {
+            "time": np.datetime64(int(self.t[-1]), "s"),
+            "scale": self.scale,
+            "t": delta_encode(self.t[start:]),
+            "lat": delta_encode(self.lat[start:]),
+            "lon": delta_encode(self.lon[start:]),
+        }
+
+    def __len__(self):
+        return len(self.t)
+
+
+class TrackPublisher(object):
+    def __init__(self, publisher, platform_id, full_interval=600, **buffer_options):
+        self.publisher = publisher
+        self.topic = "platform/{}/track".format(platform_id)
+        self.full_interval = full_interval
+        self.buffer = TrackBuffer(**buffer_options)
+        self._last_full = -float("inf")
+
+    def update(self, times, lats, lons):
+        appended = self.buffer.extend(times, lats, lons)
+        if appended == 0:
+            return
+        now = time.monotonic()
+        # if trimming removed older points as well, only a full track replaces them correctly
+        if now - self._last_full >= self.full_interval or appended >= len(self.buffer):
+            self.publisher.publish(self.topic, self.buffer.payload(), retain=True)
+            self._last_full = now
+        else:
+            self.publisher.publish(self.topic + "/append", self.buffer.payload(len(self.buffer) - appended))
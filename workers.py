@@ -0,0 +1,65 @@
+"""
+Optional process pool for the heavy parsing steps of the importers.
+
+Parse functions take raw response content (bytes or str) and return compact
+results (NumPy columns, small dicts), so little has to be pickled between
+the processes. With `processes=0` everything is parsed in this process on
+the thread pool of the `poller.AsyncHttpClient`, like before.
+
+The pool is started lazily with the `forkserver` method (`spawn` where it is
+not available), so the workers do not inherit the threads of the importer.
+If a worker dies (e.g. killed for running out of memory), the broken pool is
+replaced and the parse is retried once.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+
+
+class ParsePool(object):
+    def __init__(self, processes=0):
+        self.processes = processes
+        self._executor = None
+
+    @property
+    def enabled(self):
+        return self.processes is not None and self.processes > 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+        return self._executor
+
+    async def parse(self, http, func, *args):
+        """
+        Run `func(*args)` in a worker process, or on the thread pool of `http` if the pool is disabled.
+
+        `func` has to be a module-level function for the process pool.
+        """
+        with metrics.parse_timer():
+            if not self.enabled:
+                return await http.run(func, *args)
+            import asyncio
+            loop = asyncio.get_running_loop()
+            executor = self._get_executor()
+            try:
+                return await loop.run_in_executor(executor, func, *args)
+            except BrokenProcessPool:
+                print("parse pool broken, restarting it")
+                self._reset(executor)
+                return await loop.run_in_executor(self._get_executor(), func, *args)
+
+    def _reset(self, executor):
+        # concurrent parses all see the same broken pool, only replace it once
+        if self._executor is executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None